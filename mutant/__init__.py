@@ -11,3 +11,31 @@ __version__ = get_version(VERSION)
 logger = logging.getLogger('mutant')
 
 default_app_config = 'mutant.apps.MutantConfig'
+
+
+def batch_schema_changes():
+    """
+    Return a context manager that applies the schema alterations performed
+    within it at once when it exits.
+    """
+    from .management import batch_schema_changes
+    return batch_schema_changes()
+
+
+def defer_model_class_regeneration():
+    """
+    Return a context manager that regenerates the model classes altered
+    within it once when it exits.
+    """
+    from .models.model import defer_model_class_regeneration
+    return defer_model_class_regeneration()
+
+
+def preload(freeze=False):
+    """
+    Construct all the mutable model classes and make the state handler ready
+    to be shared with forked processes, e.g. in a preforking server master
+    process.
+    """
+    from .models import ModelDefinition
+    return ModelDefinition.objects.preload(freeze=freeze)
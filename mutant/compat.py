@@ -103,6 +103,14 @@ else:
                         )
                     unrendered_models = new_unrendered_models
 
+if django.VERSION >= (1, 10):
+    from django.db.models import prefetch_related_objects
+else:
+    from django.db.models.query import prefetch_related_objects as _prefetch_related_objects
+
+    def prefetch_related_objects(model_instances, *related_lookups):
+        return _prefetch_related_objects(model_instances, related_lookups)
+
 get_remote_field = attrgetter('remote_field' if django.VERSION >= (1, 9) else 'rel')
 
 
@@ -116,3 +124,9 @@ if django.VERSION >= (1, 9):
 else:
     def get_remote_field_model(field):
         return getattr(getattr(field, 'rel', None), 'to', None)
+
+
+if django.VERSION >= (1, 10):
+    from django.utils.deprecation import MiddlewareMixin
+else:
+    MiddlewareMixin = object
@@ -1,6 +1,7 @@
 from __future__ import unicode_literals
 
 from django.apps import AppConfig
+from django.db import models
 
 from ...signals import mutable_class_prepared
 
@@ -11,3 +12,9 @@ class RelatedConfig(AppConfig):
     def ready(self):
         from . import management
         mutable_class_prepared.connect(management.mutable_model_prepared)
+        for model_name in ('ForeignKeyDefinition', 'OneToOneFieldDefinition', 'ManyToManyFieldDefinition'):
+            models.signals.post_save.connect(
+                management.related_field_definition_post_save,
+                sender=self.get_model(model_name),
+                dispatch_uid="mutant.contrib.related.management.%s_post_save" % model_name.lower(),
+            )
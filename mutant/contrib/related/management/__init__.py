@@ -1,12 +1,15 @@
 from __future__ import unicode_literals
 
-from django.db.models import Q
 from django.db.models.fields.related import RelatedField
 from django.utils.six import string_types
 
+from .... import settings
 from ....compat import clear_opts_related_cache, get_remote_field_model
-from ....db.models import MutableModel
+from ....db.models import DeferredDependenciesOptions, MutableModel
+from ....management import nonraw_instance
 from ....models import ModelDefinition
+from ....models.model.managers import get_warming_definitions
+from ..models import DependencyEdge
 
 
 def mutable_model_prepared(signal, sender, definition, existing_model_class,
@@ -33,14 +36,33 @@ def mutable_model_prepared(signal, sender, definition, existing_model_class,
                         remote_field_model._definition != sender._definition):
                     remote_field_model._dependencies.add(sender._definition)
     # Mark all model referring to this one as dependencies
-    related_model_defs = ModelDefinition.objects.filter(
-        Q(fielddefinitions__foreignkeydefinition__to=definition) |
-        Q(fielddefinitions__manytomanyfielddefinition__to=definition)
-    ).distinct()
-    for model_def in related_model_defs:
-        if model_def != definition:
-            # Generate model class from definition and add it as a dependency
-            sender._dependencies.add(model_def.model_class()._definition)
+    referrer_pks = DependencyEdge.objects.referrers([definition.pk])
+    referrer_pks.discard(definition.pk)
+    if referrer_pks and settings.LAZY_RELATED_MODELS:
+        # Their model classes, and thus the sender's reverse relationships,
+        # are constructed on first retrieval.
+        dependencies = set((ModelDefinition, pk) for pk in referrer_pks)
+        sender._dependencies.update(dependencies)
+        sender._deferred_dependencies.update(dependencies)
+        sender._meta.__class__ = DeferredDependenciesOptions
+    elif referrer_pks:
+        # The model classes of definitions that are being warmed up are
+        # constructed from their prefetched state by the warm-up itself.
+        warming_pks = referrer_pks.intersection(get_warming_definitions())
+        sender._dependencies.update((ModelDefinition, pk) for pk in warming_pks)
+        referrer_pks.difference_update(warming_pks)
+        if referrer_pks:
+            # Generate model classes from definitions to make sure their
+            # reverse relationships are attached to the sender and add them
+            # as dependencies.
+            related_model_defs = ModelDefinition.objects.filter(pk__in=referrer_pks)
+            for model_class in related_model_defs.model_classes():
+                sender._dependencies.add(model_class._definition)
     # Clear the referenced models opts related cache
     for model_class in referenced_models:
         clear_opts_related_cache(model_class)
+
+
+@nonraw_instance
+def related_field_definition_post_save(sender, instance, created, **kwargs):
+    DependencyEdge.objects.set_field_def_edges(instance, created=created)
@@ -1,5 +1,7 @@
 from __future__ import unicode_literals
 
+from django.db import models
+
 from ...managers import FilteredQuerysetManager
 from ...models import FieldDefinitionManager
 
@@ -7,3 +9,37 @@ from ...models import FieldDefinitionManager
 class ForeignKeyDefinitionManager(FilteredQuerysetManager,
                                   FieldDefinitionManager):
     pass
+
+
+class DependencyEdgeManager(models.Manager):
+    def set_field_def_edges(self, field_def, created=False):
+        """Replace the edges of `field_def` by its current dependencies."""
+        if not created:
+            self.filter(field_def_id=field_def.pk).delete()
+        self.bulk_create([
+            self.model(field_def_id=field_def.pk, model_def_id=field_def.model_def_id, to_id=to_id)
+            for to_id in set(field_def.get_dependencies())
+        ])
+
+    def referrers(self, definition_pks):
+        """
+        Return the primary keys of the model definitions referring to the
+        content types identified by `definition_pks`.
+        """
+        return set(
+            self.filter(to_id__in=list(definition_pks)).values_list('model_def_id', flat=True)
+        )
+
+    def blast_radius(self, definition_pk):
+        """
+        Return the primary keys of the model definitions depending, directly
+        or not, on the one identified by `definition_pk` and whose model
+        class would be invalidated by a change to it.
+        """
+        affected = set()
+        referenced = set([definition_pk])
+        while referenced:
+            referenced = self.referrers(referenced) - affected
+            referenced.discard(definition_pk)
+            affected.update(referenced)
+        return affected
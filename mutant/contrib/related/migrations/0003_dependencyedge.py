@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def create_dependency_edges(apps, schema_editor):
+    DependencyEdge = apps.get_model('related', 'DependencyEdge')
+    edges = set()
+    for model_name, dependency_fields in [('ForeignKeyDefinition', ['to']),
+                                          ('ManyToManyFieldDefinition', ['to', 'through'])]:
+        field_defs = apps.get_model('related', model_name).objects.values_list(
+            'pk', 'model_def', *dependency_fields
+        )
+        for row in field_defs:
+            field_def_pk, model_def_pk = row[:2]
+            edges.update(
+                (field_def_pk, model_def_pk, to_id) for to_id in row[2:] if to_id is not None
+            )
+    DependencyEdge.objects.bulk_create([
+        DependencyEdge(field_def_id=field_def_pk, model_def_id=model_def_pk, to_id=to_id)
+        for field_def_pk, model_def_pk, to_id in edges
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mutant', '0001_initial'),
+        ('contenttypes', '0001_initial'),
+        ('related', '0002_update_field_defs_app_label'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DependencyEdge',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('field_def', models.ForeignKey(
+                    to='mutant.FieldDefinition', on_delete=models.CASCADE, related_name='dependency_edges'
+                )),
+                ('model_def', models.ForeignKey(
+                    to='mutant.ModelDefinition', on_delete=models.CASCADE, related_name='dependency_edges'
+                )),
+                ('to', models.ForeignKey(
+                    to='contenttypes.ContentType', on_delete=models.CASCADE, related_name='+'
+                )),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='dependencyedge',
+            unique_together=set([('field_def', 'to')]),
+        ),
+        migrations.RunPython(create_dependency_edges, migrations.RunPython.noop),
+    ]
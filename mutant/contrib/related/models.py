@@ -2,7 +2,7 @@ from __future__ import unicode_literals
 
 from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import ValidationError
-from django.db.models import deletion, fields
+from django.db.models import deletion, fields, Model
 from django.utils.translation import ugettext_lazy as _
 from picklefield.fields import PickledObjectField
 
@@ -10,7 +10,7 @@ from ...compat import get_remote_field
 from ...db.fields import PythonIdentifierField
 from ...db.models import MutableModel
 from ...models import FieldDefinition, FieldDefinitionManager, ModelDefinition
-from .managers import ForeignKeyDefinitionManager
+from .managers import DependencyEdgeManager, ForeignKeyDefinitionManager
 
 related_name_help_text = _('The name to use for the relation from the '
                            'related object back to this one.')
@@ -97,6 +97,9 @@ class RelatedFieldDefinition(FieldDefinition):
         # Migrations require a resolved reference.
         return self.construct(to=self.to.model_class())
 
+    def get_dependencies(self):
+        return (self.to_id,)
+
     def save(self, *args, **kwargs):
         save = super(RelatedFieldDefinition, self).save()
         if self.to_model_class_is_mutable:
@@ -122,7 +125,7 @@ class SET(object):
         collector.add_field_update(field, value, sub_objs)
 
     def deconstruct(self):
-        return ("%s.%s" % (self.__module__, self.__name__), (self.value,), {})
+        return ("%s.%s" % (self.__module__, self.__class__.__name__), (self.value,), {})
 
 SET_NULL = SET(None)
 
@@ -290,8 +293,35 @@ class ManyToManyFieldDefinition(RelatedFieldDefinition):
             options['through'] = self.through.model_class()
         return options
 
+    def get_dependencies(self):
+        dependencies = super(ManyToManyFieldDefinition, self).get_dependencies()
+        if self.through_id:
+            dependencies += (self.through_id,)
+        return dependencies
+
     def get_bound_field(self):
         opts = self.model_def.model_class(force_create=True)._meta
         for field in opts.many_to_many:
             if getattr(field, self.FIELD_DEFINITION_PK_ATTR, None) == self.pk:
                 return field
+
+
+class DependencyEdge(Model):
+    """
+    Reference from a model definition to a content type through one of its
+    related field definitions, maintained to allow reverse lookups of the
+    definitions depending on a model without joining field definitions.
+    """
+    field_def = fields.related.ForeignKey(
+        FieldDefinition, on_delete=deletion.CASCADE, related_name='dependency_edges'
+    )
+    model_def = fields.related.ForeignKey(
+        ModelDefinition, on_delete=deletion.CASCADE, related_name='dependency_edges'
+    )
+    to = fields.related.ForeignKey(ContentType, on_delete=deletion.CASCADE, related_name='+')
+
+    objects = DependencyEdgeManager()
+
+    class Meta:
+        app_label = 'related'
+        unique_together = (('field_def', 'to'),)
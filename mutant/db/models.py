@@ -1,14 +1,33 @@
 from __future__ import unicode_literals
 
+from collections import defaultdict, OrderedDict
+from contextlib import contextmanager
+from itertools import chain
+from threading import local, Lock
+from weakref import WeakValueDictionary
+
+import django
+from django.apps import apps
 from django.core.exceptions import ValidationError
 from django.db import models
 from django.db.migrations.state import ModelState
+from django.db.models.fields import FieldDoesNotExist
+from django.db.models.options import Options
 from django.utils.six import string_types
 from django.utils.translation import ugettext_lazy as _
 
-from .. import logger
-from ..compat import get_remote_field_model, StateApps
+from .. import logger, settings
+from ..compat import get_remote_field, get_remote_field_model, StateApps
 from ..state import handler as state_handler
+from ..utils import remove_from_app_cache
+
+# Latest model class constructed for each definition. Classes are weakly
+# referenced to allow obsolete ones to be garbage collected.
+_registry = WeakValueDictionary()
+# Latest rendered state of each definition along the checksum and the key of
+# the states of the mutable models it refers to. Entries are forgotten when
+# the model class of their definition is deleted or evicted.
+_rendered_states = {}
 
 
 class MutableModel(models.Model):
@@ -38,8 +57,78 @@ class MutableModel(models.Model):
     def get_model_state(cls):
         return ModelState.from_model(cls)
 
+    @classmethod
+    def get_rendered_state_key(cls):
+        """
+        Return a key identifying the states of the mutable models the
+        rendered state of this model class is built from.
+        """
+        opts = cls._meta
+        models = set(opts.get_parent_list())
+        for field in chain(opts.local_fields, opts.local_many_to_many):
+            if get_remote_field(field) is None:
+                continue
+            related_model = get_remote_field_model(field)
+            if not isinstance(related_model, string_types):
+                models.add(related_model)
+                models.update(related_model._meta.get_parent_list())
+        key = set()
+        for model in models:
+            # The states are built from the registered model classes.
+            model_opts = model._meta
+            model = opts.apps.get_model(model_opts.app_label, model_opts.model_name)
+            if issubclass(model, MutableModel) and model is not cls:
+                key.add((model._definition, model._checksum))
+        return frozenset(key)
+
     @classmethod
     def render_state(cls):
+        """
+        Render the state of this model class in an isolated registry suitable
+        for schema alterations.
+
+        The rendered model is cached by definition and checksum until one of
+        the mutable models it refers to is altered.
+        """
+        key = cls.get_rendered_state_key()
+        cached = _rendered_states.get(cls._definition)
+        if cached is not None and cached[:2] == (cls._checksum, key):
+            return cached[2]
+        model = cls._render_state()
+        _rendered_states[cls._definition] = (cls._checksum, key, model)
+        return model
+
+    @classmethod
+    def patch_rendered_state(cls, existing_model_class, removed=None, added=None):
+        """
+        Derive the rendered state of this model class from the one of
+        `existing_model_class` by replacing its field named `removed` by the
+        `added` (name, field) pair instead of rendering it again.
+        """
+        cached = _rendered_states.get(cls._definition)
+        if cached is None or cached[0] != existing_model_class._checksum:
+            return
+        checksum, key, model = cached
+        opts = model._meta
+        if removed is not None:
+            try:
+                opts.local_fields.remove(opts.get_field(removed))
+            except (FieldDoesNotExist, ValueError):
+                # Not a local field, render it again on next retrieval.
+                cls.forget_rendered_state()
+                return
+        if added is not None:
+            name, field = added
+            field.clone().contribute_to_class(model, name)
+        opts._expire_cache()
+        _rendered_states[cls._definition] = (cls._checksum, key, model)
+
+    @classmethod
+    def forget_rendered_state(cls):
+        _rendered_states.pop(cls._definition, None)
+
+    @classmethod
+    def _render_state(cls):
         apps = StateApps([], {})
         state = cls.get_model_state()
         model_states = {(state.app_label, state.name): state}
@@ -61,22 +150,45 @@ class MutableModel(models.Model):
 
     @classmethod
     def mark_as_obsolete(cls, origin=None):
-        cls._is_obsolete = True
-        logger.debug(
-            "Marking model %s and it dependencies (%s) as obsolete.",
-            cls, cls._dependencies
-        )
-        if origin is None:
-            origin = cls._definition
-        for definition_cls, definition_pk in cls._dependencies:
-            if (definition_cls, definition_pk) == origin:
-                continue
-            try:
-                definition = definition_cls.objects.get(pk=definition_pk)
-            except definition_cls.DoesNotExist:
-                pass
-            else:
-                definition.model_class().mark_as_obsolete(origin)
+        """
+        Mark this model class and the constructed model classes depending on
+        it, directly or not, as obsolete.
+        """
+        visited = set([cls._definition])
+        if origin is not None:
+            visited.add(origin)
+        model_classes = [cls]
+        while model_classes:
+            model_class = model_classes.pop()
+            model_class._is_obsolete = True
+            logger.debug(
+                "Marking model %s and it dependencies (%s) as obsolete.",
+                model_class, model_class._dependencies
+            )
+            for definition in model_class._dependencies:
+                if definition in visited:
+                    continue
+                visited.add(definition)
+                # Dependencies that were not constructed don't have to be
+                # marked as obsolete.
+                dependency = _registry.get(definition)
+                if dependency is not None:
+                    model_classes.append(dependency)
+
+    @classmethod
+    def construct_deferred_dependencies(cls):
+        """
+        Construct the model classes of the dependencies whose construction
+        was deferred, e.g. the ones referring to this model class when
+        related models are lazily constructed.
+        """
+        dependencies = defaultdict(list)
+        deferred_dependencies = cls._deferred_dependencies
+        while deferred_dependencies:
+            definition_cls, definition_pk = deferred_dependencies.pop()
+            dependencies[definition_cls].append(definition_pk)
+        for definition_cls, definition_pks in dependencies.items():
+            definition_cls.objects.filter(pk__in=definition_pks).model_classes()
 
     def clean(self):
         if self.is_obsolete():
@@ -94,3 +206,149 @@ class MutableModel(models.Model):
             msg = _('Cannot delete an obsolete model')
             raise ValidationError(msg)
         return super(MutableModel, self).delete(*args, **kwargs)
+
+
+class DeferredDependenciesOptions(Options):
+    """
+    Options of mutable model classes with deferred dependencies that
+    construct them before reverse relationships are retrieved, e.g. by the
+    deletion collector when cascading.
+    """
+
+    if django.VERSION >= (1, 8):
+        def _get_fields(self, forward=True, reverse=True, **kwargs):
+            if reverse:
+                self.model.construct_deferred_dependencies()
+            return super(DeferredDependenciesOptions, self)._get_fields(
+                forward=forward, reverse=reverse, **kwargs
+            )
+    else:
+        def _fill_related_objects_cache(self):
+            self.model.construct_deferred_dependencies()
+            return super(DeferredDependenciesOptions, self)._fill_related_objects_cache()
+
+        def _fill_related_many_to_many_cache(self):
+            self.model.construct_deferred_dependencies()
+            return super(DeferredDependenciesOptions, self)._fill_related_many_to_many_cache()
+
+
+class ModelClassCache(object):
+    """
+    Size bounded LRU of the live mutable model classes.
+
+    Least recently used classes are removed from the app registry and
+    flagged as evicted once more than `size` classes are live, their proxies
+    transparently construct them again on next access. Evicted classes are
+    not obsolete; instances of them can still be saved and deleted. Classes
+    other constructed classes depend on are never evicted and evictions are
+    deferred until the constructions in progress in the current thread
+    complete. A falsy `size` disables tracking.
+    """
+
+    def __init__(self, size=None):
+        self.size = size
+        self.classes = OrderedDict()
+        self.lock = Lock()
+        self.local = local()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.classes)
+
+    def touch(self, model_class):
+        """Record a retrieval of `model_class` that didn't require its
+        construction."""
+        if not self.size:
+            return
+        definition = model_class._definition
+        with self.lock:
+            self.hits += 1
+            if self.classes.get(definition) is model_class:
+                # Move it to the end.
+                del self.classes[definition]
+                self.classes[definition] = model_class
+
+    def add(self, model_class):
+        """Record the construction of `model_class` and evict the least
+        recently used classes if the cache is full."""
+        if not self.size:
+            return
+        definition = model_class._definition
+        with self.lock:
+            self.misses += 1
+            self.classes.pop(definition, None)
+            self.classes[definition] = model_class
+        if not getattr(self.local, 'depth', 0):
+            self.evict_overflow()
+
+    @contextmanager
+    def deferring(self):
+        """Defer evictions until the outermost block of the current thread
+        exits to avoid evicting the classes a construction relies on."""
+        depth = getattr(self.local, 'depth', 0)
+        self.local.depth = depth + 1
+        try:
+            yield
+        finally:
+            self.local.depth = depth
+        if not depth and self.size:
+            self.evict_overflow()
+
+    @staticmethod
+    def has_dependents(model_class):
+        for definition in model_class._dependencies:
+            dependency = _registry.get(definition)
+            if dependency is not None and not dependency._is_evicted:
+                return True
+        return False
+
+    def evict_overflow(self):
+        """Evict the least recently used classes beyond `size`."""
+        evicted = []
+        with self.lock:
+            # The most recently used class is never evicted.
+            for definition, model_class in list(self.classes.items())[:-1]:
+                if len(self.classes) <= self.size:
+                    break
+                # Evicting it would require its dependents to be constructed
+                # again.
+                if not self.has_dependents(model_class):
+                    del self.classes[definition]
+                    evicted.append(model_class)
+            self.evictions += len(evicted)
+        for model_class in evicted:
+            self.evict(model_class)
+
+    def evict(self, model_class):
+        opts = model_class._meta
+        # Make sure not to remove a more recent class of the same definition.
+        if opts.apps.all_models[opts.app_label].get(opts.model_name) is model_class:
+            remove_from_app_cache(model_class, quiet=True)
+            # Rendered states are kept for the latest class of a definition.
+            model_class.forget_rendered_state()
+        model_class._is_evicted = True
+        logger.debug("Evicted model class %s.", model_class)
+
+    def clear(self):
+        with self.lock:
+            self.classes.clear()
+            self.hits = self.misses = self.evictions = 0
+
+model_class_cache = ModelClassCache(settings.MODEL_CLASS_CACHE_SIZE)
+
+
+def register_mutable_model(model_class):
+    """Register `model_class` as the latest one of its definition."""
+    _registry[model_class._definition] = model_class
+    model_class_cache.add(model_class)
+
+
+def get_mutable_models():
+    """Return the mutable models registered in the app registry."""
+    return [
+        model for app_models in list(apps.all_models.values())
+        for model in list(app_models.values())
+        if issubclass(model, MutableModel)
+    ]
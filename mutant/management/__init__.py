@@ -1,6 +1,9 @@
 from __future__ import unicode_literals
 
+from collections import OrderedDict
+from contextlib import contextmanager
 from functools import wraps
+from threading import local
 
 from django.contrib.contenttypes.models import ContentType
 from django.db import connections, models, transaction
@@ -10,17 +13,92 @@ from ..compat import get_remote_field
 from ..state import handler as state_handler
 from ..utils import allow_migrate, popattr, remove_from_app_cache
 
+_batch = local()
+
 
 def perform_ddl(action, model, *args, **kwargs):
     if model._meta.managed:
         return
 
+    operations = getattr(_batch, 'operations', None)
+    if operations is not None:
+        from ..models.model import MutableModelProxy
+        # Proxies must be resolved right away since the model class they
+        # point to might be replaced by the time the operation is applied.
+        if isinstance(model, MutableModelProxy):
+            model = model.__get__()
+        operations.append((action, model, args, kwargs))
+        return
+
     for alias in allow_migrate(model):
         connection = connections[alias]
         with transaction.atomic(alias), connection.schema_editor() as editor:
             getattr(editor, action)(model, *args, **kwargs)
 
 
+def merge_operations(connection, operations):
+    """
+    Merge the fields successively added to a table into a single table
+    rebuild on backends that rebuild tables to alter them.
+    """
+    if connection.vendor != 'sqlite':
+        return operations
+    merged = []
+    created_fields = {}
+    for action, model, args, kwargs in operations:
+        db_table = model._meta.db_table
+        if action == 'add_field' and not args[0].many_to_many:
+            fields = created_fields.get(db_table)
+            if fields is None:
+                # The model the first field is added to is missing all of them.
+                created_fields[db_table] = fields = []
+                merged.append(('_remake_table', model, (), {'create_fields': fields}))
+            fields.append(args[0])
+            continue
+        # Don't merge additions across other alterations of the table.
+        created_fields.pop(db_table, None)
+        if action == 'alter_db_table':
+            created_fields.pop(args[0], None)
+        merged.append((action, model, args, kwargs))
+    return merged
+
+
+def apply_operations(operations):
+    """Apply the queued `operations` in a single schema editor session per
+    database."""
+    alias_operations = OrderedDict()
+    for operation in operations:
+        for alias in allow_migrate(operation[1]):
+            alias_operations.setdefault(alias, []).append(operation)
+    for alias, operations in alias_operations.items():
+        connection = connections[alias]
+        with transaction.atomic(alias), connection.schema_editor() as editor:
+            for action, model, args, kwargs in merge_operations(connection, operations):
+                getattr(editor, action)(model, *args, **kwargs)
+
+
+@contextmanager
+def batch_schema_changes():
+    """
+    Queue the schema alterations performed in the block and apply them on
+    exit in a single schema editor session per database.
+
+    Tables are not altered until the block exits. Since the definitions
+    saved in the block are not rolled back if an exception is raised the
+    queued alterations are also applied in this case.
+    """
+    if getattr(_batch, 'operations', None) is not None:
+        # Nested blocks are part of the outermost one.
+        yield
+        return
+    _batch.operations = operations = []
+    try:
+        yield
+    finally:
+        _batch.operations = None
+        apply_operations(operations)
+
+
 def nonraw_instance(receiver):
     """
     A signal receiver decorator that fetch the complete instance from db when
@@ -84,7 +162,9 @@ def model_definition_post_save(sender, instance, created, **kwargs):
 
 
 def model_definition_pre_delete(sender, instance, **kwargs):
-    model_class = instance.model_class()
+    # Keep a reference to the model class itself since the deletion of its
+    # attributes can mark it as obsolete.
+    model_class = instance.model_class().model
     instance._state._deletion = (
         model_class,
         instance.pk,
@@ -96,6 +176,7 @@ def model_definition_post_delete(sender, instance, **kwargs):
     perform_ddl('delete_model', model_class)
     remove_from_app_cache(model_class)
     model_class.mark_as_obsolete()
+    model_class.forget_rendered_state()
     state_handler.clear_checksum(pk)
     ContentType.objects.clear_cache()
     del instance._model_class
@@ -23,7 +23,6 @@ class Command(BaseCommand):
             )
 
         # Generate model class associated with model classes.
-        for model_def in model_defs:
-            model_def.model_class()
+        ModelDefinition.objects.warm_model_classes(model_defs)
 
         return super(Command, self).handle(*app_labels, **options)
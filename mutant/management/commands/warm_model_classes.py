@@ -0,0 +1,25 @@
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand
+
+from ...models import ModelDefinition
+
+
+class Command(BaseCommand):
+    help = 'Construct the model classes of all model definitions in bulk.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'app_label', nargs='*',
+            help='Restrict the constructed model classes to these applications.'
+        )
+
+    def handle(self, *args, **options):
+        model_defs = ModelDefinition.objects.all()
+        app_labels = options.get('app_label') or args
+        if app_labels:
+            model_defs = model_defs.filter(app_label__in=app_labels)
+        timings = ModelDefinition.objects.warm_model_classes(model_defs)
+        if options['verbosity'] >= 1:
+            for phase, duration in timings.items():
+                self.stdout.write("%s: %.3fs" % (phase, duration))
@@ -0,0 +1,22 @@
+from __future__ import unicode_literals
+
+from .compat import MiddlewareMixin
+from .state import handler as state_handler
+
+
+class StateSnapshotMiddleware(MiddlewareMixin):
+    """
+    Trust the checksums of the mutable models retrieved during a request
+    until it ends.
+
+    The snapshot starts empty and the checksums are retrieved as the models
+    are accessed to avoid retrieving the ones of all the mutable models on
+    every request.
+    """
+
+    def process_request(self, request):
+        state_handler.start_snapshot(())
+
+    def process_response(self, request, response):
+        state_handler.end_snapshot()
+        return response
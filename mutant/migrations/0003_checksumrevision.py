@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mutant', '0002_modeldefinition_checksum'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChecksumRevision',
+            fields=[
+                ('revision', models.AutoField(serialize=False, verbose_name='revision', primary_key=True)),
+                ('definition_pk', models.PositiveIntegerField(db_index=True, verbose_name='definition pk')),
+                ('checksum', models.CharField(max_length=64, null=True, verbose_name='checksum')),
+            ],
+            options={
+                'verbose_name': 'checksum revision',
+                'verbose_name_plural': 'checksum revisions',
+            },
+        ),
+    ]
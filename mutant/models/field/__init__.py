@@ -4,7 +4,7 @@ import warnings
 
 from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import ImproperlyConfigured, ValidationError
-from django.db import models
+from django.db import models, router, transaction
 from django.db.models import signals
 from django.utils import six
 from django.utils.translation import ugettext_lazy as _
@@ -17,7 +17,7 @@ from ...db.fields import (
 )
 from ...hacks import patch_model_option_verbose_name_raw
 from ...utils import lazy_string_format, popattr
-from ..model import ModelDefinitionAttribute
+from ..model import defer_regeneration, ModelDefinitionAttribute
 from ..ordered import OrderedModel
 from .managers import FieldDefinitionChoiceManager, FieldDefinitionManager
 
@@ -224,6 +224,20 @@ class FieldDefinition(six.with_metaclass(FieldDefinitionBase, BasePolymorphicMod
             return delete
         return super(FieldDefinition, self).delete(*args, **kwargs)
 
+    def refresh_model_class(self, force_create=True, deleted=False):
+        # Patch the existing model class instead of rebuilding it from scratch
+        # when the change is limited to this field.
+        if force_create:
+            try:
+                added = None if deleted else (self.name, self.construct())
+            except NotImplementedError:
+                pass  # `get_field_class` is not implemented
+            else:
+                removed = getattr(self, '_saved_name', None)
+                if self.model_def.patch_model_class(removed, added) is not None:
+                    return
+        super(FieldDefinition, self).refresh_model_class(force_create, deleted)
+
     def clone(self):
         options = dict(
             (name, getattr(self, name))
@@ -293,6 +307,13 @@ class FieldDefinition(six.with_metaclass(FieldDefinitionBase, BasePolymorphicMod
         """
         return self.construct()
 
+    def get_dependencies(self):
+        """
+        Return the primary keys of the content types the constructed field
+        refers to.
+        """
+        return ()
+
     def clean(self):
         # Make sure we can build the field
         try:
@@ -343,8 +364,12 @@ class FieldDefinitionChoice(OrderedModel):
             raise ValidationError({'value': e.messages})
 
     def save(self, *args, **kwargs):
-        save = super(FieldDefinitionChoice, self).save(*args, **kwargs)
-        self.field_def.model_def.model_class(force_create=True)
+        using = kwargs.get('using') or router.db_for_write(self.__class__, instance=self)
+        with transaction.atomic(using):
+            save = super(FieldDefinitionChoice, self).save(*args, **kwargs)
+            model_def = self.field_def.model_def
+            if not defer_regeneration(model_def):
+                model_def.model_class(force_create=True)
         return save
 
     def get_ordering_queryset(self):
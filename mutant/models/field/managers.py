@@ -17,6 +17,15 @@ class FieldDefinitionQuerySet(PolymorphicQuerySet):
         obj.save(force_insert=True, using=self.db)
         return obj
 
+    def names(self):
+        # Sort in Python to rely on the same ordering when the field
+        # definitions were prefetched.
+        if self._result_cache is None:
+            names = self.values_list('name', flat=True)
+        else:
+            names = (field_def.name for field_def in self)
+        return sorted(names)
+
 
 class FieldDefinitionManager(PolymorphicManager):
     def get_queryset(self):
@@ -39,8 +48,7 @@ class FieldDefinitionManager(PolymorphicManager):
                       model_def__model=model, name=name)
 
     def names(self):
-        qs = self.get_queryset()
-        return qs.order_by('name').values_list('name', flat=True)
+        return self.get_queryset().names()
 
     def create_with_default(self, default, **kwargs):
         qs = self.get_queryset()
@@ -51,9 +59,14 @@ class FieldDefinitionChoiceQuerySet(models.query.QuerySet):
     def construct(self):
         # Here we don't use .values() since it's raw output from the database
         # and values are not prepared correctly.
+        if self._result_cache is None:
+            queryset = self.only('group', 'value', 'label')
+        else:
+            # Choices were prefetched.
+            queryset = self
         choices = (
             {'group': choice.group, 'label': choice.label, 'value': choice.value}
-            for choice in self.only('group', 'value', 'label')
+            for choice in queryset
         )
         return tuple(choices_from_dict(choices))
 
@@ -1,29 +1,122 @@
 from __future__ import unicode_literals
 
-import pickle
-from hashlib import md5
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import reduce
+from operator import or_
+from threading import local, Lock, RLock
+from time import time
+from weakref import WeakValueDictionary
 
 from django.apps import apps
 from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import ValidationError
-from django.db import models
+from django.db import models, router, transaction
 from django.db.migrations.state import ModelState
 from django.db.models.constants import LOOKUP_SEP
 from django.db.models.fields import FieldDoesNotExist
 from django.utils.encoding import python_2_unicode_compatible
+from django.utils.six import string_types
 from django.utils.translation import ugettext_lazy as _
 from picklefield.fields import PickledObjectField
 
-from ... import logger
-from ...compat import get_remote_field_model
+from ... import logger, settings
+from ...compat import (
+    get_remote_field, get_remote_field_model, prefetch_related_objects,
+)
 from ...db.deletion import CASCADE_MARK_ORIGIN
 from ...db.fields import LazilyTranslatedField, PythonIdentifierField
-from ...db.models import MutableModel
+from ...db.models import (
+    model_class_cache, MutableModel, register_mutable_model,
+)
 from ...signals import mutable_class_prepared
 from ...state import handler as state_handler
-from ...utils import get_db_table, get_foward_fields, remove_from_app_cache
+from ...utils import (
+    get_checksum, get_db_table, get_foward_fields, remove_from_app_cache,
+)
 from ..ordered import OrderedModel
-from .managers import ModelDefinitionManager
+from .cache import model_state_cache
+from .managers import get_state_lookups, ModelDefinitionManager
+
+
+_deferred = local()
+_construction = local()
+# Locks are only kept around while threads are holding or waiting on them.
+_construction_locks = WeakValueDictionary()
+_construction_locks_lock = Lock()
+
+
+@contextmanager
+def construction_lock(definition_pk):
+    """
+    Serialize the construction of the model class of a definition across
+    threads. Yield whether or not the lock was acquired.
+    """
+    with _construction_locks_lock:
+        lock = _construction_locks.get(definition_pk)
+        if lock is None:
+            lock = _construction_locks[definition_pk] = RLock()
+    depth = getattr(_construction, 'depth', 0)
+    # Threads that are already constructing a model class don't wait for
+    # others since they might be waiting for them in return.
+    acquired = lock.acquire(not depth)
+    _construction.depth = depth + 1
+    try:
+        with model_class_cache.deferring():
+            yield acquired
+    finally:
+        _construction.depth = depth
+        if acquired:
+            lock.release()
+
+
+@contextmanager
+def defer_model_class_regeneration():
+    """
+    Defer the regeneration of model classes triggered by alterations of
+    definition attributes that don't affect the schema until the block
+    exits, at which point each altered definition is regenerated once.
+
+    Model classes retrieved within the block don't reflect these deferred
+    alterations.
+    """
+    if getattr(_deferred, 'definitions', None) is not None:
+        # Nested blocks are part of the outermost one.
+        yield
+        return
+    _deferred.definitions = definitions = OrderedDict()
+    try:
+        yield
+    except Exception:
+        # The alterations that were persisted must be published to other
+        # processes, regenerate the definitions right away.
+        for model_def in definitions.values():
+            try:
+                model_def.model_class(force_create=True)
+            except Exception:
+                logger.exception("Failed to regenerate the model class of %s.", model_def)
+                # Make sure the class is regenerated on its next retrieval.
+                model_class = super(ModelDefinition, model_def).model_class()
+                if model_class is not None:
+                    model_class._is_obsolete = True
+        raise
+    finally:
+        _deferred.definitions = None
+    for model_def in definitions.values():
+        model_def.model_class(force_create=True)
+
+
+def defer_regeneration(model_def):
+    """
+    Record `model_def` for regeneration at the end of the current
+    `defer_model_class_regeneration` block if any and return whether or not
+    it was.
+    """
+    definitions = getattr(_deferred, 'definitions', None)
+    if definitions is None:
+        return False
+    definitions[model_def.pk] = model_def
+    return True
 
 
 def _model_class_from_pk(definition_cls, definition_pk):
@@ -37,8 +130,27 @@ def _model_class_from_pk(definition_cls, definition_pk):
         pass
 
 
+_unchecked = object()
+_proxy_attributes = frozenset([
+    'model', 'refreshing', 'checked', '__get__', '__eq__', '__ne__', '__reduce_ex__'
+])
+
+
+def _trusted_model(checked):
+    """
+    Return the model class of the last staleness check of a proxy if it
+    can be trusted, that is if the state handler generation didn't move and
+    it was performed less than `STATE_MAX_STALENESS` seconds ago.
+    """
+    model, handler, generation, checked_at = checked
+    if (handler is state_handler._handler and handler.generation == generation and
+            time() - checked_at < settings.STATE_MAX_STALENESS and
+            not model._is_obsolete and not model._is_evicted):
+        return model
+
+
 class MutableModelProxy(object):
-    __slots__ = ['model', 'refreshing', '__weakref__']
+    __slots__ = ['model', 'refreshing', 'checked', '__weakref__']
 
     proxied_methods = [
         '__setattr__', '__delattr__', '__hash__', '__str__'
@@ -77,11 +189,24 @@ class MutableModelProxy(object):
         supset = super(MutableModelProxy, self).__setattr__
         supset('model', model)
         supset('refreshing', False)
+        # Model class, handler, generation and time of the last staleness
+        # check.
+        supset('checked', (model, _unchecked, None, 0))
 
     def __get__(self, instance=None, owner=None):
-        model = self.model
-        if not self.refreshing and model.is_obsolete():
-            supset = super(MutableModelProxy, self).__setattr__
+        # Bypass the proxied `__getattribute__` since this is called on
+        # every attribute access.
+        get = object.__getattribute__
+        model = _trusted_model(get(self, 'checked'))
+        if model is not None:
+            return model
+        model = get(self, 'model')
+        if get(self, 'refreshing'):
+            return model
+        supset = super(MutableModelProxy, self).__setattr__
+        handler = state_handler.get_handler()
+        generation = handler.generation
+        if model._is_evicted or model.is_obsolete():
             try:
                 supset('refreshing', True)
                 try:
@@ -100,13 +225,22 @@ class MutableModelProxy(object):
                 assert isinstance(proxy, MutableModelProxy)
                 model = proxy.model
                 supset('model', model)
+                # Building the model class alters the state.
+                generation = handler.generation
+        else:
+            model_class_cache.touch(model)
+        supset('checked', (model, handler, generation, time()))
         return model
 
     def __getattribute__(self, name):
-        if name in ('model', 'refreshing', '__get__', '__eq__', '__ne__', '__reduce_ex__'):
-            return super(MutableModelProxy, self).__getattribute__(name)
-        model = super(MutableModelProxy, self).__getattribute__('__get__')()
-        return getattr(model, name)
+        get = object.__getattribute__
+        if name in _proxy_attributes:
+            return get(self, name)
+        # Avoid the call to `__get__` when the last check can be trusted.
+        model = _trusted_model(get(self, 'checked'))
+        if model is not None:
+            return getattr(model, name)
+        return getattr(get(self, '__get__')(), name)
 
     def __call__(self, *args, **kwargs):
         model = self.__get__()
@@ -145,6 +279,9 @@ class ModelDefinition(ContentType):
     verbose_name_plural = LazilyTranslatedField(
         _('verbose name plural'), blank=True, null=True
     )
+    checksum = models.CharField(
+        _('checksum'), max_length=64, null=True, editable=False, serialize=False
+    )
 
     objects = ModelDefinitionManager()
 
@@ -245,22 +382,44 @@ class ModelDefinition(ContentType):
             '__module__': __module__,
             '_definition': (self.__class__, self.pk),
             '_dependencies': set(),
+            '_deferred_dependencies': set(),
             '_is_obsolete': False,
+            '_is_evicted': False,
         }
         return attrs
 
+    def prefetch_state(self):
+        """
+        Fetch the attributes required to build the state of this definition
+        unless they were already prefetched through
+        `ModelDefinitionQuerySet.prefetch_state`.
+        """
+        if not hasattr(self, '_state_fielddefinitions'):
+            prefetch_related_objects([self], *get_state_lookups())
+
+    def clear_prefetched_state(self):
+        try:
+            del self._state_fielddefinitions
+        except AttributeError:
+            pass
+        prefetched_objects_cache = getattr(self, '_prefetched_objects_cache', {})
+        for lookup in ('uniquetogetherdefinitions', 'orderingfielddefinitions', 'basedefinitions'):
+            prefetched_objects_cache.pop(lookup, None)
+
     def get_state(self):
-        fields = [
-            (field_def.name, field_def.construct()) for field_def in self.fielddefinitions.select_subclasses()
-        ]
-        options = self.get_model_opts()
-        bases = self.get_model_bases()
+        self.prefetch_state()
+        try:
+            fields = [
+                (field_def.name, field_def.construct()) for field_def in self._state_fielddefinitions
+            ]
+            options = self.get_model_opts()
+            bases = self.get_model_bases()
+        finally:
+            # Make sure the next retrieval reflects the current state.
+            self.clear_prefetched_state()
         return ModelState(self.app_label, self.object_name, fields=fields, options=options, bases=bases)
 
-    def construct(self, force_create=False, existing_model_class=None):
-        state = self.get_state()
-        attrs = self.get_model_attrs()
-
+    def get_state_checksum(self, state):
         identifier = (
             self.pk, self.object_name, state.options, dict(
                 (name, field.deconstruct()) for name, field in state.fields
@@ -270,20 +429,87 @@ class ModelDefinition(ContentType):
                 for base in state.bases
             ]
         )
-        checksum = md5(pickle.dumps(identifier)).hexdigest()
-        state_handler.set_checksum(self.pk, checksum)
+        return get_checksum(identifier)
+
+    def construct(self, force_create=False, existing_model_class=None):
+        # Trust the checksum stored along the definition when the state
+        # handler lost track of it to avoid rebuilding the state.
+        if (existing_model_class and not force_create and
+                not existing_model_class._is_obsolete and
+                self.checksum is not None and
+                existing_model_class._checksum == self.checksum and
+                state_handler.get_checksum(self.pk) is None):
+            state_handler.set_checksum(self.pk, self.checksum)
+            return existing_model_class
+
+        state = None
+        if not force_create:
+            # Existing classes with the last known checksum might have been
+            # marked as obsolete because of alterations that are not
+            # reflected by it yet.
+            checksum = state_handler.get_checksum(self.pk) or self.checksum
+            if existing_model_class is None or existing_model_class._checksum != checksum:
+                state = model_state_cache.get(self.pk, checksum)
+        if state is None:
+            state = self.get_state()
+            checksum = self.get_state_checksum(state)
+            model_state_cache.set(self.pk, checksum, state)
+        definitions = getattr(_deferred, 'definitions', None)
+        if definitions:
+            # The state reflects the deferred alterations.
+            definitions.pop(self.pk, None)
+        self.store_checksum(checksum)
 
         if existing_model_class:
             if not force_create and existing_model_class._checksum == checksum:
                 existing_model_class._is_obsolete = False
                 return existing_model_class
+
+        model_class = self.render_model_class(state, checksum, existing_model_class)
+        self.construct_referenced_models(model_class)
+        return model_class
+
+    def construct_referenced_models(self, model_class):
+        """
+        Construct the mutable models `model_class` refers to that are not
+        registered yet to resolve its relationships, e.g. when it's the first
+        model class constructed by a process.
+        """
+        fields = [field for field in get_foward_fields(model_class._meta) if get_remote_field(field)]
+        lookups = []
+        for field in fields:
+            remote_field_model = get_remote_field_model(field)
+            if isinstance(remote_field_model, string_types):
+                app_label, object_name = remote_field_model.split('.')
+                lookups.append(models.Q(app_label=app_label, model=object_name.lower()))
+        if lookups:
+            self.__class__.objects.filter(reduce(or_, lookups)).model_classes()
+        for field in fields:
+            # Expire the related models cached while they were unresolved,
+            # including the ones resolved by the construction of referrers.
+            if isinstance(field.__dict__.get('related_model'), string_types):
+                del field.__dict__['related_model']
+
+    def store_checksum(self, checksum):
+        if checksum != self.checksum and self.pk is not None:
+            self.__class__.objects.filter(pk=self.pk).update(checksum=checksum)
+            self.checksum = checksum
+        state_handler.set_checksum(self.pk, checksum)
+
+    def render_model_class(self, state, checksum, existing_model_class=None):
+        attrs = self.get_model_attrs()
+
+        if existing_model_class:
             remove_from_app_cache(existing_model_class)
             existing_model_class.mark_as_obsolete()
 
         model_class = state.render(apps)
         model_class._checksum = checksum
+        # Kept around to allow the class to be patched on field changes.
+        model_class._model_state = state
         for attr, value in attrs.items():
             setattr(model_class, attr, value)
+        register_mutable_model(model_class)
 
         mutable_class_prepared.send(
             sender=model_class, definition=self,
@@ -293,12 +519,100 @@ class ModelDefinition(ContentType):
 
         return model_class
 
+    def patch_model_class(self, removed=None, added=None):
+        """
+        Derive a new model class from the existing one by replacing its field
+        named `removed` by the `added` (name, field) pair instead of rebuilding
+        the state from the definition attributes.
+
+        Return None if there's no up to date class to patch or the change
+        might affect other parts of the state, e.g. when it involves mutable
+        bases, relationships, the primary key or model options.
+        """
+        if removed is None and added is None:
+            return None
+        existing_model_class = super(ModelDefinition, self).model_class()
+        if existing_model_class is None or existing_model_class.is_obsolete():
+            return None
+        state = getattr(existing_model_class, '_model_state', None)
+        if state is None or state.name != self.object_name:
+            return None
+        # The checksum of mutable bases must be retrieved from their definition.
+        if any(base is not MutableModel and issubclass(base, MutableModel) for base in state.bases):
+            return None
+        fields = list(state.fields)
+        names = [name for name, _field in fields]
+        changed = []
+        index = len(fields)
+        if removed is not None:
+            if removed not in names:
+                return None
+            index = names.index(removed)
+            changed.append(fields.pop(index)[1])
+        if added is not None:
+            if added[0] != removed and added[0] in names:
+                return None
+            fields.insert(index, added)
+            changed.append(added[1])
+        for field in changed:
+            if field.primary_key or get_remote_field(field):
+                return None
+        if removed is not None and (added is None or added[0] != removed):
+            referenced = set(
+                lookup.lstrip('-').split(LOOKUP_SEP)[0] for lookup in state.options.get('ordering', ())
+            )
+            for unique_together in state.options.get('unique_together', ()):
+                referenced.update(unique_together)
+            if removed in referenced:
+                return None
+        state = ModelState(
+            self.app_label, self.object_name, fields=fields, options=dict(state.options), bases=state.bases
+        )
+        checksum = self.get_state_checksum(state)
+        model_state_cache.set(self.pk, checksum, state)
+        self.store_checksum(checksum)
+        model_class = self.render_model_class(state, checksum, existing_model_class)
+        model_class.patch_rendered_state(existing_model_class, removed, added)
+        return MutableModelProxy(model_class)
+
+    def construct_once(self, force_create=False):
+        """
+        Construct the model class unless it was constructed by another thread
+        while waiting for its construction to complete.
+        """
+        with construction_lock(self.pk):
+            model_class = super(ModelDefinition, self).model_class()
+            if force_create or model_class is None or model_class.is_obsolete():
+                model_class = self.construct(force_create, model_class)
+            return model_class
+
     def model_class(self, force_create=False):
-        model_class = super(ModelDefinition, self).model_class()
+        existing_model_class = model_class = super(ModelDefinition, self).model_class()
         if force_create or model_class is None or model_class.is_obsolete():
-            model_class = self.construct(force_create, model_class)
+            model_class = self.construct_once(force_create)
+        if model_class is existing_model_class:
+            model_class_cache.touch(model_class)
         return MutableModelProxy(model_class)
 
+    @classmethod
+    def model_classes(cls, model_defs):
+        """
+        Return the model classes of `model_defs` while retrieving the
+        checksums required to determine if they are obsolete at once.
+        """
+        model_defs = list(model_defs)
+        checksums = state_handler.get_checksums([model_def.pk for model_def in model_defs])
+        model_classes = []
+        for model_def in model_defs:
+            existing_model_class = model_class = super(ModelDefinition, model_def).model_class()
+            if (model_class is None or model_class._is_obsolete or
+                    model_class._checksum != checksums[model_def.pk]):
+                model_class = model_def.construct_once()
+            if model_class is existing_model_class:
+                model_class_cache.touch(model_class)
+            model_classes.append(MutableModelProxy(model_class))
+        return model_classes
+
     @property
     def model_ct(self):
         try:
@@ -328,21 +642,36 @@ class ModelDefinitionAttribute(models.Model):
         on_delete=CASCADE_MARK_ORIGIN
     )
 
+    # Whether or not the schema alterations performed on changes rely on an
+    # up to date model class.
+    alters_schema = True
+
     class Meta:
         abstract = True
 
     def save(self, *args, **kwargs):
         force_create = kwargs.pop('force_create_model_class', True)
-        save = super(ModelDefinitionAttribute, self).save(*args, **kwargs)
-        self.model_def.model_class(force_create=force_create)
+        using = kwargs.get('using') or router.db_for_write(self.__class__, instance=self)
+        # Make sure the definition checksum is updated in the same transaction.
+        with transaction.atomic(using):
+            save = super(ModelDefinitionAttribute, self).save(*args, **kwargs)
+            self.refresh_model_class(force_create)
         return save
 
     def delete(self, *args, **kwargs):
         force_create = kwargs.pop('force_create_model_class', True)
-        delete = super(ModelDefinitionAttribute, self).delete(*args, **kwargs)
-        self.model_def.model_class(force_create=force_create)
+        using = kwargs.get('using') or router.db_for_write(self.__class__, instance=self)
+        with transaction.atomic(using):
+            delete = super(ModelDefinitionAttribute, self).delete(*args, **kwargs)
+            self.refresh_model_class(force_create, deleted=True)
         return delete
 
+    def refresh_model_class(self, force_create=True, deleted=False):
+        """Update the model class of the definition after a change."""
+        if force_create and not self.alters_schema and defer_regeneration(self.model_def):
+            return
+        self.model_def.model_class(force_create=force_create)
+
 
 class OrderedModelDefinitionAttribute(OrderedModel, ModelDefinitionAttribute):
     class Meta:
@@ -409,6 +738,8 @@ class OrderingFieldDefinition(OrderedModelDefinitionAttribute):
     lookup = models.CharField(max_length=255)
     descending = models.BooleanField(_('descending'), default=False)
 
+    alters_schema = False
+
     class Meta:
         app_label = 'mutant'
         ordering = ['order']
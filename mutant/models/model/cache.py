@@ -0,0 +1,109 @@
+from __future__ import unicode_literals
+
+import os
+import pickle
+import tempfile
+
+from django.db.migrations.state import ModelState
+from django.utils.module_loading import import_string
+
+from ... import logger, settings
+from ...db.models import MutableModel
+from ...utils import CHECKSUM_VERSION
+
+
+class ModelStateCache(object):
+    """
+    Directory of pickled model definition states keyed by their definition
+    pk and checksum shared by the processes of a host.
+
+    Since a checksum identifies the state it was computed from entries never
+    have to be invalidated. Files are written atomically and the least
+    recently used ones are removed when there's more than `size` of them.
+    """
+
+    suffix = '.state'
+
+    def __init__(self, directory=None, size=1024):
+        self.directory = directory
+        self.size = size
+
+    def get_path(self, definition_pk, checksum):
+        return os.path.join(self.directory, "%s-%s%s" % (definition_pk, checksum, self.suffix))
+
+    def get(self, definition_pk, checksum):
+        """Return the cached state of `definition_pk` matching `checksum`."""
+        if not self.directory or not checksum:
+            return None
+        path = self.get_path(definition_pk, checksum)
+        try:
+            with open(path, 'rb') as state_file:
+                version, app_label, name, fields, options, bases = pickle.load(state_file)
+            if version != CHECKSUM_VERSION:
+                return None
+            fields = [
+                (field_name, import_string(field_path)(*args, **kwargs))
+                for field_name, field_path, args, kwargs in fields
+            ]
+            # Record the access for eviction purposes.
+            os.utime(path, None)
+        except (IOError, OSError):
+            return None
+        except Exception:
+            logger.exception("Failed to load the cached state %s.", path)
+            return None
+        return ModelState(app_label, name, fields=fields, options=options, bases=bases)
+
+    def set(self, definition_pk, checksum, state):
+        if not self.directory or not checksum:
+            return
+        # The checksum of mutable bases is not part of the cache key.
+        if any(base is not MutableModel and issubclass(base, MutableModel) for base in state.bases):
+            return
+        fields = []
+        for name, field in state.fields:
+            _name, path, args, kwargs = field.deconstruct()
+            fields.append((name, path, args, kwargs))
+        try:
+            data = pickle.dumps(
+                (CHECKSUM_VERSION, state.app_label, state.name, fields, state.options, state.bases),
+                pickle.HIGHEST_PROTOCOL,
+            )
+        except Exception:
+            logger.exception("Failed to pickle the state of definition %s.", definition_pk)
+            return
+        try:
+            fd, temp_path = tempfile.mkstemp(dir=self.directory)
+            try:
+                with os.fdopen(fd, 'wb') as temp_file:
+                    temp_file.write(data)
+                os.rename(temp_path, self.get_path(definition_pk, checksum))
+            except Exception:
+                os.unlink(temp_path)
+                raise
+            self.evict()
+        except (IOError, OSError):
+            logger.exception("Failed to cache the state of definition %s.", definition_pk)
+
+    def evict(self):
+        """Remove the least recently used states beyond `size`."""
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(self.suffix):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                entries.append((os.stat(path).st_mtime, path))
+            except OSError:
+                # Removed by another process.
+                continue
+        if len(entries) <= self.size:
+            return
+        entries.sort()
+        for _mtime, path in entries[:len(entries) - self.size]:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+model_state_cache = ModelStateCache(settings.MODEL_STATE_CACHE_DIR, settings.MODEL_STATE_CACHE_SIZE)
@@ -1,10 +1,248 @@
 from __future__ import unicode_literals
 
-from django.db import models
+import gc
+import warnings
+from collections import OrderedDict
+from threading import local
+from time import time
+
+import django
+from django.contrib.contenttypes.models import ContentType
+from django.db import connections, models
+from django.db.models import Prefetch
+from django.db.models.fields import FieldDoesNotExist
+
+from ... import logger
+from ...compat import get_remote_field, get_remote_field_model
+from ...utils import apps_bulk_update
+
+_warming = local()
+
+
+def get_warming_definitions():
+    """
+    Return the primary keys of the definitions whose model classes are being
+    constructed by a `warm_model_classes` call of the current thread.
+    """
+    return getattr(_warming, 'definitions', frozenset())
+
+
+def get_state_lookups():
+    """
+    Lookups required to build the state of a model definition without
+    issuing queries for each of its attributes.
+    """
+    from ..field import FieldDefinition
+    queryset = FieldDefinition.objects.select_subclasses().prefetch_related('choices')
+    # Related field definitions refer to their target through its content
+    # type and the definition of mutable targets.
+    related = set()
+    for subclass, (_attrs, _proxy, path) in FieldDefinition.subclass_accessors.items():
+        try:
+            to = subclass._meta.get_field('to')
+        except FieldDoesNotExist:
+            continue
+        if path and get_remote_field(to) and issubclass(ContentType, get_remote_field_model(to)):
+            related.add("%s__to__modeldefinition" % path)
+    if related:
+        queryset = queryset.select_related(*sorted(related))
+    return (
+        Prefetch('fielddefinitions', queryset=queryset, to_attr='_state_fielddefinitions'),
+        'uniquetogetherdefinitions__field_defs',
+        'orderingfielddefinitions',
+        'basedefinitions',
+    )
+
+
+def get_definition_dependencies(model_def):
+    """
+    Return the primary keys of the definitions `model_def` prefetched state
+    refers to through its bases and fields.
+    """
+    from ...db.models import MutableModel
+    dependencies = set()
+    for base_def in model_def.basedefinitions.all():
+        base = base_def.construct()
+        if isinstance(base, type) and issubclass(base, MutableModel):
+            dependencies.add(base._definition[1])
+    for field_def in model_def._state_fielddefinitions:
+        dependencies.update(field_def.get_dependencies())
+    dependencies.discard(model_def.pk)
+    return dependencies
+
+
+def sort_by_dependencies(model_defs):
+    """
+    Sort prefetched model definitions in a way that definitions appear after
+    the ones they depend on. Dependency loops are broken arbitrarily.
+    """
+    model_defs = OrderedDict((model_def.pk, model_def) for model_def in model_defs)
+    dependencies = dict(
+        (pk, get_definition_dependencies(model_def)) for pk, model_def in model_defs.items()
+    )
+    ordered = []
+    visited = set()
+    for pk in model_defs:
+        if pk in visited:
+            continue
+        visited.add(pk)
+        stack = [(pk, iter(dependencies[pk]))]
+        while stack:
+            current, remaining = stack[-1]
+            for dependency in remaining:
+                if dependency in model_defs and dependency not in visited:
+                    visited.add(dependency)
+                    stack.append((dependency, iter(dependencies[dependency])))
+                    break
+            else:
+                stack.pop()
+                ordered.append(model_defs[current])
+    return ordered
+
+
+class ModelDefinitionQuerySet(models.query.QuerySet):
+    def prefetch_state(self):
+        """
+        Fetch the attributes required to build the state of the retrieved
+        definitions in a fixed number of queries.
+        """
+        lookups = get_state_lookups()
+        # Prefetch objects are compared by their prefetch_to attribute.
+        if lookups[0] in self._prefetch_related_lookups:
+            return self.all()
+        return self.prefetch_related(*lookups)
+
+    def checksums(self):
+        """
+        Return a mapping of the retrieved definitions primary keys to their
+        stored checksums.
+        """
+        return dict(self.values_list('pk', 'checksum'))
+
+    def model_classes(self):
+        return self.model.model_classes(self)
 
 
 class ModelDefinitionManager(models.Manager):
     use_for_related_fields = True
 
+    def get_queryset(self):
+        return ModelDefinitionQuerySet(self.model, using=self._db)
+
+    if django.VERSION < (1, 8):
+        def get_query_set(self):
+            warnings.warn(
+                "`ModelDefinitionManager.get_query_set` is deprecated, "
+                "use `get_queryset` instead.",
+                DeprecationWarning if django.VERSION >= (1, 7)
+                else PendingDeprecationWarning,
+                stacklevel=2
+            )
+            return ModelDefinitionManager.get_queryset(self)
+
     def get_by_natural_key(self, app_label, model):
         return self.get(app_label=app_label, model=model)
+
+    def prefetch_state(self):
+        return self.get_queryset().prefetch_state()
+
+    def checksums(self):
+        return self.get_queryset().checksums()
+
+    def check_model_classes(self, queryset=None):
+        """
+        Compare the checksums of the model classes constructed by this
+        process against the ones stored in the database in a single query.
+
+        The state handler is seeded with the checksums of up to date classes
+        it lost track of and outdated classes are marked as obsolete. Return
+        the primary keys of the definitions whose class is obsolete.
+        """
+        from ...db.models import get_mutable_models
+        from ...state import handler as state_handler
+        if queryset is None:
+            queryset = self.get_queryset()
+        checksums = queryset.checksums()
+        obsolete = set()
+        # Definitions that were not constructed since the checksum column was
+        # added cannot be compared.
+        model_classes = [
+            model_class for model_class in get_mutable_models() if checksums.get(model_class._definition[1])
+        ]
+        handler_checksums = state_handler.get_checksums(
+            [model_class._definition[1] for model_class in model_classes]
+        )
+        seeds = {}
+        for model_class in model_classes:
+            definition_pk = model_class._definition[1]
+            checksum = checksums[definition_pk]
+            if model_class._is_obsolete:
+                obsolete.add(definition_pk)
+            elif model_class._checksum != checksum:
+                model_class.mark_as_obsolete()
+                obsolete.add(definition_pk)
+            elif handler_checksums[definition_pk] is None:
+                seeds[definition_pk] = checksum
+        if seeds:
+            state_handler.set_checksums(seeds)
+        return obsolete
+
+    def warm_model_classes(self, queryset=None):
+        """
+        Construct the model classes of all the definitions of `queryset` in a
+        single pass and return the time spent in each phase.
+        """
+        if queryset is None:
+            queryset = self.get_queryset()
+        timings = OrderedDict()
+        start = time()
+        model_defs = list(queryset.prefetch_state())
+        timings['load'] = time() - start
+        start = time()
+        model_defs = sort_by_dependencies(model_defs)
+        timings['order'] = time() - start
+        start = time()
+        warming = get_warming_definitions()
+        _warming.definitions = warming | frozenset(model_def.pk for model_def in model_defs)
+        try:
+            with apps_bulk_update():
+                self.model.model_classes(model_defs)
+        finally:
+            _warming.definitions = warming
+        # The prefetched state is not used if the model class was already
+        # constructed.
+        for model_def in model_defs:
+            model_def.clear_prefetched_state()
+        timings['render'] = time() - start
+        logger.debug(
+            "Warmed %d model classes (%s).", len(model_defs),
+            ', '.join("%s: %.3fs" % timing for timing in timings.items())
+        )
+        return timings
+
+    def preload(self, queryset=None, freeze=False):
+        """
+        Prepare a process that is about to be forked by constructing the model
+        classes of all the definitions of `queryset` and seeding the state
+        handler with their checksums.
+
+        Database connections are closed since they can't be shared with the
+        forked processes. When `freeze` is true the objects tracked by the
+        garbage collector are moved to a permanent generation (Python 3.7+)
+        to prevent collections from copying the pages they live in.
+        """
+        from ...state import handler as state_handler
+        timings = self.warm_model_classes(queryset)
+        # Forked processes re-establish the resources of the handler created
+        # here instead of creating their own.
+        state_handler.get_handler()
+        self.check_model_classes(queryset)
+        for connection in connections.all():
+            # Closing a connection would abort the ongoing transaction.
+            if not connection.in_atomic_block:
+                connection.close()
+        if freeze:
+            gc.collect()
+            if hasattr(gc, 'freeze'):
+                gc.freeze()
+        return timings
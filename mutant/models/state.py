@@ -0,0 +1,21 @@
+from __future__ import unicode_literals
+
+from django.db import models
+from django.utils.translation import ugettext_lazy as _
+
+
+class ChecksumRevision(models.Model):
+    """
+    Latest known checksum of a model definition used by the database state
+    handler. A row is inserted on every change in order to assign it an
+    increasing revision and the superseded ones are removed; cleared
+    checksums are kept as null ones.
+    """
+    revision = models.AutoField(_('revision'), primary_key=True)
+    definition_pk = models.PositiveIntegerField(_('definition pk'), db_index=True)
+    checksum = models.CharField(_('checksum'), max_length=64, null=True)
+
+    class Meta:
+        app_label = 'mutant'
+        verbose_name = _('checksum revision')
+        verbose_name_plural = _('checksum revisions')
@@ -17,3 +17,31 @@ STATE_PUBSUB = getattr(
         'mutant.state.handlers.pubsub.engines.Redis', {}
     )
 )
+
+STATE_MAX_STALENESS = getattr(
+    settings, 'MUTANT_STATE_MAX_STALENESS', 0
+) or 0
+
+STATE_DATABASE_POLL_INTERVAL = getattr(
+    settings, 'MUTANT_STATE_DATABASE_POLL_INTERVAL', 1
+)
+
+STATE_DATABASE_POLL_OVERLAP = getattr(
+    settings, 'MUTANT_STATE_DATABASE_POLL_OVERLAP', 60
+)
+
+LAZY_RELATED_MODELS = getattr(
+    settings, 'MUTANT_LAZY_RELATED_MODELS', False
+)
+
+MODEL_CLASS_CACHE_SIZE = getattr(
+    settings, 'MUTANT_MODEL_CLASS_CACHE_SIZE', None
+)
+
+MODEL_STATE_CACHE_DIR = getattr(
+    settings, 'MUTANT_MODEL_STATE_CACHE_DIR', None
+)
+
+MODEL_STATE_CACHE_SIZE = getattr(
+    settings, 'MUTANT_MODEL_STATE_CACHE_SIZE', 1024
+)
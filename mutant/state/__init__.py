@@ -4,3 +4,17 @@ from ..settings import STATE_HANDLER
 from .utils import HandlerProxy
 
 handler = HandlerProxy(STATE_HANDLER)
+
+
+def get_definition_pks():
+    from ..db.models import get_mutable_models
+    return [model._definition[1] for model in get_mutable_models()]
+
+
+def snapshot():
+    """
+    Retrieve the checksums of all the mutable models at once and trust them
+    in the current thread until the context is exited to make sure the unit
+    of work sees a consistent version of them.
+    """
+    return handler.snapshot(get_definition_pks())
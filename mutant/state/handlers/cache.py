@@ -1,5 +1,7 @@
 from __future__ import unicode_literals
 
+from threading import Lock
+
 from django.core.cache import caches
 
 from ...settings import STATE_CACHE_ALIAS
@@ -7,10 +9,23 @@ from ...settings import STATE_CACHE_ALIAS
 
 class CacheStateHandler(object):
     """State handlers that relies on cache to store and retrieve the current
-    checksum of a definition."""
+    checksum of a definition.
+
+    Since changes made by other processes can't be observed locally the
+    `generation` counter is only bumped by changes made by this process."""
+
+    generation = 0
+    generation_lock = Lock()
 
-    def __init__(self):
-        self.cache = caches[STATE_CACHE_ALIAS]
+    @staticmethod
+    def bump_generation():
+        with CacheStateHandler.generation_lock:
+            CacheStateHandler.generation += 1
+
+    @property
+    def cache(self):
+        # Cache connections are thread local.
+        return caches[STATE_CACHE_ALIAS]
 
     def get_cache_key(self, definition_pk):
         return "mutant-%s" % definition_pk
@@ -19,10 +34,30 @@ class CacheStateHandler(object):
         cache_key = self.get_cache_key(definition_pk)
         return self.cache.get(cache_key)
 
+    def get_checksums(self, definition_pks):
+        cache_keys = dict(
+            (self.get_cache_key(definition_pk), definition_pk) for definition_pk in definition_pks
+        )
+        checksums = self.cache.get_many(list(cache_keys))
+        return dict(
+            (definition_pk, checksums.get(cache_key)) for cache_key, definition_pk in cache_keys.items()
+        )
+
     def set_checksum(self, definition_pk, checksum):
         cache_key = self.get_cache_key(definition_pk)
-        return self.cache.set(cache_key, checksum)
+        result = self.cache.set(cache_key, checksum)
+        self.bump_generation()
+        return result
+
+    def set_checksums(self, checksums):
+        result = self.cache.set_many(dict(
+            (self.get_cache_key(definition_pk), checksum) for definition_pk, checksum in checksums.items()
+        ))
+        self.bump_generation()
+        return result
 
     def clear_checksum(self, definition_pk):
         cache_key = self.get_cache_key(definition_pk)
-        return self.cache.delete(cache_key)
+        result = self.cache.delete(cache_key)
+        self.bump_generation()
+        return result
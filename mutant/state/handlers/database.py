@@ -0,0 +1,175 @@
+from __future__ import unicode_literals
+
+from collections import deque
+from functools import reduce
+from operator import or_
+from threading import Event, RLock, Thread
+from time import time
+
+from django.db import close_old_connections, connections, router, transaction
+from django.db.models import Q
+
+from ... import logger
+from ...settings import (
+    STATE_DATABASE_POLL_INTERVAL, STATE_DATABASE_POLL_OVERLAP,
+)
+
+
+class DatabaseStatePoller(Thread):
+    def __init__(self, handler, interval):
+        super(DatabaseStatePoller, self).__init__(name='mutant-state-database-poller')
+        self.daemon = True
+        self.handler = handler
+        self.interval = interval
+        self.stopped = Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            close_old_connections()
+            try:
+                self.handler.poll()
+            except Exception:
+                logger.exception('Failed to poll checksum revisions.')
+
+    def stop(self):
+        self.stopped.set()
+
+
+class DatabaseStateHandler(object):
+    """State handler that stores checksums along an increasing revision in
+    a table and maintains a local map of them by retrieving the revisions it
+    hasn't seen yet every `poll_interval` seconds from a background thread.
+
+    Since revisions are assigned when changes are written but only visible
+    once committed, the changes of the last `poll_overlap` seconds are
+    retrieved again on every poll and only applied if their revision is
+    newer than the one of the known checksum of their definition. Changes
+    committed more than `poll_overlap` seconds after they were written
+    might be missed.
+
+    Rows are appended and the superseded ones removed afterwards which
+    allows concurrent changes to the same definition to be stored.
+
+    Retrieving a checksum never hits the database which means changes made
+    by other processes are only observed once they've been polled."""
+
+    checksums = {}
+    generation = 0
+    lock = RLock()
+    revision = None
+    checkpoints = None
+    poll_interval = STATE_DATABASE_POLL_INTERVAL
+    poll_overlap = STATE_DATABASE_POLL_OVERLAP
+    poller = None
+
+    def __init__(self):
+        cls = self.__class__
+        with self.lock:
+            if cls.revision is None:
+                self.poll()
+            if self.poll_interval and cls.poller is None:
+                cls.poller = DatabaseStatePoller(self, self.poll_interval)
+                cls.poller.start()
+
+    def after_fork(self):
+        """Restart polling since the thread doesn't survive the fork."""
+        cls = self.__class__
+        cls.lock = RLock()
+        cls.poller = None
+        self.poll()
+        if self.poll_interval:
+            cls.poller = DatabaseStatePoller(self, self.poll_interval)
+            cls.poller.start()
+
+    def get_watermark(self, now):
+        """Return the revision from which changes must be retrieved."""
+        checkpoints = self.checkpoints
+        if not checkpoints:
+            return 0
+        # Keep the most recent checkpoint that is older than the overlap.
+        while len(checkpoints) > 1 and checkpoints[1][0] <= now - self.poll_overlap:
+            checkpoints.popleft()
+        return checkpoints[0][1]
+
+    def apply(self, definition_pk, checksum, revision):
+        """Apply a polled change unless a newer one is known and return
+        whether or not the checksum of `definition_pk` changed."""
+        entry = self.checksums.get(definition_pk)
+        if entry is not None and (entry[1] > revision or entry == (checksum, revision)):
+            return False
+        self.checksums[definition_pk] = (checksum, revision)
+        return (entry[0] if entry else None) != checksum
+
+    def poll(self):
+        """Apply the changes made since the last seen revision."""
+        from ...models import ChecksumRevision
+        cls = self.__class__
+        with self.lock:
+            if cls.checkpoints is None:
+                cls.checkpoints = deque()
+            now = time()
+            revisions = ChecksumRevision.objects.filter(
+                revision__gt=self.get_watermark(now)
+            ).order_by('revision').values_list('revision', 'definition_pk', 'checksum')
+            changed = False
+            for revision, definition_pk, checksum in revisions:
+                if self.apply(definition_pk, checksum, revision):
+                    changed = True
+                cls.revision = max(cls.revision or 0, revision)
+            if cls.revision is None:
+                cls.revision = 0
+            cls.checkpoints.append((now, cls.revision))
+            if changed:
+                DatabaseStateHandler.generation += 1
+
+    def store(self, checksums):
+        """
+        Store `checksums` and return the revisions assigned to them.
+
+        Rows are inserted at once on backends returning the primary keys of
+        bulk inserted rows and one at a time on the other ones.
+        """
+        from ...models import ChecksumRevision
+        if not checksums:
+            return {}
+        db = router.db_for_write(ChecksumRevision)
+        with transaction.atomic(db):
+            rows = [
+                ChecksumRevision(definition_pk=definition_pk, checksum=checksum)
+                for definition_pk, checksum in checksums.items()
+            ]
+            if getattr(connections[db].features, 'can_return_ids_from_bulk_insert', False):
+                ChecksumRevision.objects.bulk_create(rows)
+            else:
+                for row in rows:
+                    row.save(force_insert=True)
+            revisions = dict((row.definition_pk, row.revision) for row in rows)
+            # Superseded rows are removed after the new ones are inserted to
+            # prevent revisions from being reused.
+            ChecksumRevision.objects.filter(reduce(or_, (
+                Q(definition_pk=definition_pk, revision__lt=revision)
+                for definition_pk, revision in revisions.items()
+            ))).delete()
+        return revisions
+
+    def get_checksum(self, definition_pk):
+        entry = self.checksums.get(definition_pk)
+        if entry is not None:
+            return entry[0]
+
+    def get_checksums(self, definition_pks):
+        get_checksum = self.get_checksum
+        return dict((definition_pk, get_checksum(definition_pk)) for definition_pk in definition_pks)
+
+    def set_checksum(self, definition_pk, checksum):
+        self.set_checksums({definition_pk: checksum})
+
+    def set_checksums(self, checksums):
+        revisions = self.store(checksums)
+        with self.lock:
+            for definition_pk, checksum in checksums.items():
+                self.checksums[definition_pk] = (checksum, revisions[definition_pk])
+            DatabaseStateHandler.generation += 1
+
+    def clear_checksum(self, definition_pk):
+        self.set_checksums({definition_pk: None})
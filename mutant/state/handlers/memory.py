@@ -1,26 +1,48 @@
 from __future__ import unicode_literals
 
-from threading import RLock
+from threading import Lock
+
+from ..utils import StateMap
 
 
 class MemoryStateHandler(object):
-    """State handler that relies on a lock and an in-memory map of definition
+    """State handler that relies on an in-memory sharded map of definition
     pk and their associated checksums to maintain the current state of mutable
-    models."""
+    models.
+
+    The `generation` counter is bumped every time the map is altered which
+    allows consumers to cheaply detect that something changed since they last
+    looked at it. It's bumped under a lock since changes are applied from
+    request threads as well as from the pubsub engine thread."""
+
+    checksums = StateMap()
+    generation = 0
+    generation_lock = Lock()
 
-    checksums = {}
-    lock = RLock()
+    @staticmethod
+    def bump_generation():
+        with MemoryStateHandler.generation_lock:
+            MemoryStateHandler.generation += 1
 
     def get_checksum(self, definition_pk):
         return self.checksums.get(definition_pk)
 
+    def get_checksums(self, definition_pks):
+        get = self.checksums.get
+        return dict((definition_pk, get(definition_pk)) for definition_pk in definition_pks)
+
     def set_checksum(self, definition_pk, checksum):
-        with self.lock:
-            self.checksums[definition_pk] = checksum
+        self.checksums.set(definition_pk, checksum)
+        self.bump_generation()
+
+    def set_checksums(self, checksums):
+        for definition_pk, checksum in checksums.items():
+            self.checksums.set(definition_pk, checksum)
+        self.bump_generation()
+
+    def after_fork(self):
+        self.checksums.after_fork()
 
     def clear_checksum(self, definition_pk):
-        with self.lock:
-            try:
-                del self.checksums[definition_pk]
-            except KeyError:
-                pass
+        self.checksums.clear(definition_pk)
+        self.bump_generation()
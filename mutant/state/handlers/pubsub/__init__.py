@@ -10,34 +10,67 @@ from ..memory import MemoryStateHandler
 
 
 class PubSubStateHandler(MemoryStateHandler):
-    timestamps = {}
+    """State handler that maintains an in-memory map of checksums kept in
+    sync with other processes by publishing and receiving changes through a
+    pubsub engine.
+
+    Forked processes start their own engine and resynchronize their map with
+    the checksums stored along definitions since changes might have been
+    missed in the meantime."""
 
     def __init__(self):
         super(PubSubStateHandler, self).__init__()
+        self.engine = self.get_engine()
+        self.engine.start()
+
+    def get_engine(self):
         dotted_path, options = settings.STATE_PUBSUB
         engine_cls = import_string(dotted_path)
-        self.engine = engine_cls(self.receive, **options)
+        return engine_cls(self.receive, **options)
+
+    def after_fork(self):
+        super(PubSubStateHandler, self).after_fork()
+        # The engine thread of the parent process doesn't survive the fork
+        # and its connections must not be shared.
+        self.engine = self.get_engine()
         self.engine.start()
+        self.resync()
+
+    def resync(self):
+        """Replace the local map by the checksums stored in the database."""
+        from ....models import ModelDefinition
+        timestamp = time()
+        checksums = ModelDefinition.objects.checksums()
+        for definition_pk in self.checksums:
+            if definition_pk not in checksums:
+                self.checksums.clear(definition_pk, timestamp, newer=True)
+        for definition_pk, checksum in checksums.items():
+            if checksum:
+                self.checksums.set(definition_pk, checksum, timestamp, newer=True)
+        self.bump_generation()
 
     def receive(self, definition_pk, checksum, timestamp):
         # Do not alter current state if the change was published before our
-        if self.timestamps.get(definition_pk, timestamp) > timestamp:
-            return
-        if checksum is None:
-            super(PubSubStateHandler, self).clear_checksum(definition_pk)
-        else:
-            super(PubSubStateHandler, self).set_checksum(definition_pk, checksum)
+        # last one.
+        if self.checksums.set(definition_pk, checksum, timestamp, newer=True):
+            self.bump_generation()
 
     def set_checksum(self, definition_pk, checksum):
         timestamp = time()
-        with self.lock:
-            self.timestamps[definition_pk] = timestamp
-            super(PubSubStateHandler, self).set_checksum(definition_pk, checksum)
+        self.checksums.set(definition_pk, checksum, timestamp)
+        self.bump_generation()
         self.engine.publish(definition_pk, checksum, timestamp)
 
+    def set_checksums(self, checksums):
+        timestamp = time()
+        for definition_pk, checksum in checksums.items():
+            self.checksums.set(definition_pk, checksum, timestamp)
+        self.bump_generation()
+        for definition_pk, checksum in checksums.items():
+            self.engine.publish(definition_pk, checksum, timestamp)
+
     def clear_checksum(self, definition_pk):
         timestamp = time()
-        with self.lock:
-            self.timestamps[definition_pk] = timestamp
-            super(PubSubStateHandler, self).clear_checksum(definition_pk)
+        self.checksums.clear(definition_pk, timestamp)
+        self.bump_generation()
         self.engine.publish(definition_pk, None, timestamp)
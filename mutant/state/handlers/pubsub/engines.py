@@ -1,32 +1,296 @@
 from __future__ import unicode_literals
 
+import errno
 import json
-from threading import Thread
+import os
+import select
+import socket
+from collections import OrderedDict
+from threading import Event, Lock, Thread
+from uuid import uuid4
 
-from django.utils.encoding import force_str
+from django.db import connections, DEFAULT_DB_ALIAS
+from django.utils.encoding import force_bytes, force_str
 
+from .... import logger
 
-class Redis(Thread):
+
+class Flusher(Thread):
+    def __init__(self, engine):
+        super(Flusher, self).__init__(name="%s-flusher" % engine.name)
+        self.daemon = True
+        self.engine = engine
+
+    def run(self):
+        engine = self.engine
+        while not engine.stopped.wait(engine.flush_interval):
+            engine.flush()
+
+
+class Engine(Thread):
+    """
+    Base class of pubsub engines.
+
+    Subclasses must implement the `subscribe`, `listen` and `send` methods.
+    Subscription is retried every `retry_interval` seconds when it fails or
+    the connection is lost.
+
+    Changes are sent as soon as they are published unless a `flush_interval`
+    is specified, in which case they are coalesced and sent as a single
+    message every `flush_interval` seconds. Changes that couldn't be sent
+    are retried on the next flush.
+
+    Batches are split in messages of at most `max_message_size` bytes when
+    the transport limits the size of the messages it delivers.
+    """
+
+    thread_name = 'mutant-state-pubsub-engine'
+    max_message_size = None
+
+    def __init__(self, callback, flush_interval=0, retry_interval=1):
+        super(Engine, self).__init__(name=self.thread_name)
+        self.daemon = True
+        self.callback = callback
+        self.flush_interval = flush_interval
+        self.retry_interval = retry_interval
+        self.pending = OrderedDict()
+        self.pending_lock = Lock()
+        self.send_lock = Lock()
+        self.subscribed = Event()
+        self.stopped = Event()
+
+    def subscribe(self):
+        raise NotImplementedError
+
+    def listen(self):
+        """Yield received messages until unsubscribed."""
+        raise NotImplementedError
+
+    def unsubscribe(self):
+        pass
+
+    def send(self, message):
+        raise NotImplementedError
+
+    def start(self):
+        super(Engine, self).start()
+        if self.flush_interval:
+            Flusher(self).start()
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                self.subscribe()
+                self.subscribed.set()
+                for message in self.listen():
+                    self.dispatch(message)
+            except Exception:
+                if self.stopped.is_set():
+                    break
+                logger.exception("Lost %s subscription, retrying in %s seconds.", self.name, self.retry_interval)
+            self.subscribed.clear()
+            self.stopped.wait(self.retry_interval)
+
+    def dispatch(self, message):
+        changes = json.loads(force_str(message))
+        # Single changes are not wrapped in a list for compatibility with
+        # engines that don't batch them.
+        if changes and not isinstance(changes[0], list):
+            changes = [changes]
+        for change in changes:
+            self.callback(*change)
+
+    def publish(self, definition_pk, checksum, timestamp):
+        with self.pending_lock:
+            # Only the latest change of a definition is relevant.
+            self.pending.pop(definition_pk, None)
+            self.pending[definition_pk] = (checksum, timestamp)
+        if not self.flush_interval:
+            self.flush()
+
+    def encode(self, changes):
+        """Yield the messages `changes` are sent as along the changes they
+        are made of."""
+        max_message_size = self.max_message_size
+        if not max_message_size:
+            yield json.dumps(changes[0] if len(changes) == 1 else changes), changes
+            return
+        batch, encoded, size = [], [], 1
+        for change in changes:
+            part = json.dumps(change)
+            # Account for the separator or the closing bracket.
+            if batch and size + len(part) + 1 > max_message_size:
+                yield encoded[0] if len(batch) == 1 else "[%s]" % ','.join(encoded), batch
+                batch, encoded, size = [], [], 1
+            batch.append(change)
+            encoded.append(part)
+            size += len(part) + 1
+        yield encoded[0] if len(batch) == 1 else "[%s]" % ','.join(encoded), batch
+
+    def flush(self):
+        with self.pending_lock:
+            changes = [
+                [definition_pk, checksum, timestamp]
+                for definition_pk, (checksum, timestamp) in self.pending.items()
+            ]
+            self.pending.clear()
+        if not changes:
+            return
+        sent = 0
+        try:
+            with self.send_lock:
+                for message, batch in self.encode(changes):
+                    self.send(message)
+                    sent += len(batch)
+        except Exception:
+            logger.exception("Failed to publish %d changes through %s.", len(changes) - sent, self.name)
+            with self.pending_lock:
+                for definition_pk, checksum, timestamp in changes[sent:]:
+                    # Changes published in the meantime take precedence.
+                    self.pending.setdefault(definition_pk, (checksum, timestamp))
+
+    def join(self, timeout=None):
+        self.stopped.set()
+        self.flush()
+        self.unsubscribe()
+        return super(Engine, self).join(timeout)
+
+
+class Redis(Engine):
+    thread_name = 'mutant-state-pubsub-redis-engine'
     channel = 'mutant-state'
 
-    def __init__(self, callback, **options):
+    def __init__(self, callback, flush_interval=0, retry_interval=1, **options):
         import redis
-        super(Redis, self).__init__(name='mutant-state-pubsub-redis-engine')
-        self.callback = callback
+        super(Redis, self).__init__(callback, flush_interval, retry_interval)
         self.connection = redis.StrictRedis(**options)
-        self.pubsub = self.connection.pubsub()
+        self.pubsub = None
 
-    def run(self):
+    def subscribe(self):
+        self.pubsub = self.connection.pubsub()
         self.pubsub.subscribe(self.channel)
+
+    def listen(self):
         for event in self.pubsub.listen():
             if event['type'] == 'message':
-                args = json.loads(force_str(event['data']))
-                self.callback(*args)
+                yield event['data']
+
+    def unsubscribe(self):
+        if self.pubsub is not None:
+            self.pubsub.unsubscribe(self.channel)
 
-    def publish(self, *args):
-        message = json.dumps(args)
+    def send(self, message):
         self.connection.publish(self.channel, message)
 
-    def join(self, timeout=None):
-        self.pubsub.unsubscribe(self.channel)
-        return super(Redis, self).join(timeout)
+
+class PostgreSQL(Engine):
+    """
+    Engine relying on PostgreSQL LISTEN/NOTIFY through dedicated connections
+    to the `alias` database.
+    """
+
+    thread_name = 'mutant-state-pubsub-postgresql-engine'
+    channel = 'mutant_state'
+    # NOTIFY payloads must be shorter than 8000 bytes.
+    max_message_size = 7999
+
+    def __init__(self, callback, flush_interval=0, retry_interval=1, alias=DEFAULT_DB_ALIAS, timeout=1):
+        super(PostgreSQL, self).__init__(callback, flush_interval, retry_interval)
+        self.alias = alias
+        self.timeout = timeout
+        self.listener = None
+        self.publisher = None
+
+    def connect(self):
+        wrapper = connections[self.alias]
+        connection = wrapper.get_new_connection(wrapper.get_connection_params())
+        connection.autocommit = True
+        return connection
+
+    def subscribe(self):
+        self.listener = self.connect()
+        self.listener.cursor().execute('LISTEN "%s"' % self.channel)
+
+    def listen(self):
+        listener = self.listener
+        try:
+            while not self.stopped.is_set():
+                if select.select([listener], [], [], self.timeout) == ([], [], []):
+                    continue
+                listener.poll()
+                while listener.notifies:
+                    yield listener.notifies.pop(0).payload
+        finally:
+            listener.close()
+
+    def send(self, message):
+        if self.publisher is None:
+            self.publisher = self.connect()
+        try:
+            self.publisher.cursor().execute('SELECT pg_notify(%s, %s)', [self.channel, message])
+        except Exception:
+            self.publisher.close()
+            self.publisher = None
+            raise
+
+
+class UnixSocket(Engine):
+    """
+    Engine relying on UNIX datagram sockets bound in a `directory` shared by
+    the processes of a single host.
+    """
+
+    thread_name = 'mutant-state-pubsub-unix-socket-engine'
+    suffix = '.sock'
+    buffer_size = 65536
+    # Larger datagrams would be truncated on reception.
+    max_message_size = buffer_size
+
+    def __init__(self, callback, directory, flush_interval=0, retry_interval=1, timeout=1):
+        super(UnixSocket, self).__init__(callback, flush_interval, retry_interval)
+        self.directory = directory
+        self.timeout = timeout
+        self.path = os.path.join(directory, uuid4().hex + self.suffix)
+        self.socket = None
+
+    def subscribe(self):
+        if self.socket is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            sock.bind(self.path)
+            sock.settimeout(self.timeout)
+            self.socket = sock
+
+    def listen(self):
+        while not self.stopped.is_set():
+            try:
+                yield self.socket.recv(self.buffer_size)
+            except socket.timeout:
+                continue
+
+    def unsubscribe(self):
+        sock, self.socket = self.socket, None
+        if sock is not None:
+            sock.close()
+            os.unlink(self.path)
+
+    def send(self, message):
+        message = force_bytes(message)
+        sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            for name in os.listdir(self.directory):
+                if not name.endswith(self.suffix):
+                    continue
+                path = os.path.join(self.directory, name)
+                try:
+                    sender.sendto(message, path)
+                except (OSError, socket.error) as e:
+                    if e.errno not in (errno.ECONNREFUSED, errno.ENOENT):
+                        raise
+                    # Socket left behind by a process that didn't exit
+                    # cleanly.
+                    try:
+                        os.unlink(path)
+                    except OSError:
+                        pass
+        finally:
+            sender.close()
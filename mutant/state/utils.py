@@ -1,26 +1,291 @@
 from __future__ import unicode_literals
 
-from threading import local
+import os
+from collections import OrderedDict
+from contextlib import contextmanager
+from threading import local, Lock, RLock
+from time import time
+from weakref import WeakSet
 
 from django.utils.module_loading import import_string
 
+# Proxies whose fork lock must be re-created in forked processes.
+_proxies = WeakSet()
+
+if hasattr(os, 'register_at_fork'):
+    _process = {'pid': os.getpid()}
+
+    def _forked():
+        _process['pid'] = os.getpid()
+        # The lock might have been held by another thread at fork time.
+        for proxy in list(_proxies):
+            proxy._fork_lock = RLock()
+    os.register_at_fork(after_in_child=_forked)
+
+    def getpid():
+        return _process['pid']
+else:
+    getpid = os.getpid
+
+
+class StateMapShard(object):
+    __slots__ = ['entries', 'tombstones', 'lock']
+
+    def __init__(self):
+        self.entries = {}
+        self.tombstones = OrderedDict()
+        self.lock = Lock()
+
+
+class StateMap(object):
+    """
+    Map of definition pks to their checksum and the timestamp of their last
+    change split in shards guarded by their own lock.
+
+    Reads don't acquire any lock. Cleared checksums are kept as tombstones for
+    `tombstone_ttl` seconds in order to discard older changes received after
+    them and are then expired when their shard is written to.
+    """
+
+    def __init__(self, shards=16, tombstone_ttl=60):
+        self.shards = tuple(StateMapShard() for _i in range(shards))
+        self.tombstone_ttl = tombstone_ttl
+
+    def get_shard(self, definition_pk):
+        return self.shards[hash(definition_pk) % len(self.shards)]
+
+    def get(self, definition_pk):
+        # Inlined `get_shard` since this is called on every staleness check.
+        entry = self.shards[hash(definition_pk) % len(self.shards)].entries.get(definition_pk)
+        if entry is not None:
+            return entry[0]
+
+    def get_timestamp(self, definition_pk):
+        entry = self.get_shard(definition_pk).entries.get(definition_pk)
+        if entry is not None:
+            return entry[1]
+
+    def set(self, definition_pk, checksum, timestamp=None, newer=False):
+        """
+        Set the checksum of `definition_pk`, a `None` checksum clearing it.
+
+        When `newer` is true the change is only applied if it's not older
+        than the current one. Return whether or not it was applied.
+        """
+        now = time()
+        if timestamp is None:
+            timestamp = now
+        shard = self.shards[hash(definition_pk) % len(self.shards)]
+        with shard.lock:
+            entries = shard.entries
+            if newer:
+                entry = entries.get(definition_pk)
+                if entry is not None and entry[1] > timestamp:
+                    return False
+            entries[definition_pk] = (checksum, timestamp)
+            tombstones = shard.tombstones
+            if tombstones:
+                tombstones.pop(definition_pk, None)
+                self.expire(shard, now)
+            if checksum is None:
+                tombstones[definition_pk] = now + self.tombstone_ttl
+        return True
+
+    def clear(self, definition_pk, timestamp=None, newer=False):
+        return self.set(definition_pk, None, timestamp, newer)
+
+    def expire(self, shard, now):
+        tombstones = shard.tombstones
+        while tombstones:
+            definition_pk, expires = next(iter(tombstones.items()))
+            if expires > now:
+                break
+            del tombstones[definition_pk]
+            del shard.entries[definition_pk]
+
+    def __len__(self):
+        return sum(len(shard.entries) - len(shard.tombstones) for shard in self.shards)
+
+    def __iter__(self):
+        for shard in self.shards:
+            for definition_pk, entry in list(shard.entries.items()):
+                if entry[0] is not None:
+                    yield definition_pk
+
+    def after_fork(self):
+        # Locks held by other threads of the parent process at fork time
+        # would never be released in the child.
+        for shard in self.shards:
+            shard.lock = Lock()
+
 
 class HandlerProxy(object):
+    """
+    Proxy to a process-wide instance of the handler located at `path`.
+
+    Handlers are shared by all threads and must be thread-safe; only state
+    snapshots are thread local. Handlers defining an `after_fork` method get
+    it called the first time they are accessed from a forked process in order
+    to re-establish their resources.
+    """
+
     def __init__(self, path):
-        self._handlers = local()
+        self._handlers = {}
+        self._lock = Lock()
+        self._fork_lock = RLock()
+        self._forking = False
+        self._pid = getpid()
+        self._snapshots = local()
         self.path = path
+        _proxies.add(self)
+
+    @property
+    def path(self):
+        return self._path
 
-    def __getattribute__(self, name):
-        get = super(HandlerProxy, self).__getattribute__
+    @path.setter
+    def path(self, path):
+        self._path = path
+        # Handler of `path` last retrieved by `get_handler`.
+        self._handler = None
+
+    def get_handler(self):
+        if self._pid != getpid():
+            with self._fork_lock:
+                # Another thread might have handled the fork while waiting
+                # and handlers might access the proxy while being forked.
+                if self._pid != getpid() and not self._forking:
+                    self._forking = True
+                    try:
+                        self.forked()
+                    finally:
+                        self._forking = False
+        path = self._path
         try:
-            return get(name)
-        except AttributeError:
-            pass
-        handlers = get('_handlers')
-        path = get('path')
+            handler = self._handlers[path]
+        except KeyError:
+            with self._lock:
+                handler = self._handlers.get(path)
+                if handler is None:
+                    handler = self._handlers[path] = import_string(path)()
+        self._handler = handler
+        return handler
+
+    def forked(self):
+        """Re-establish the resources of the handlers in a forked process.
+
+        Called with `_fork_lock` held which prevents other threads from using
+        the handlers until they are ready."""
+        # The lock might have been held by another thread at fork time.
+        self._lock = Lock()
+        self._snapshots = local()
+        for handler in self._handlers.values():
+            after_fork = getattr(handler, 'after_fork', None)
+            if after_fork is not None:
+                after_fork()
+        # Other threads must not use the handlers until they are ready.
+        self._pid = getpid()
+
+    @property
+    def generation(self):
+        """
+        Counter bumped every time the locally known state changes.
+
+        Exposed as a property to avoid going through `__getattr__` since it's
+        retrieved on every mutable model proxy attribute access.
+        """
+        return self.get_handler().generation
+
+    def get_snapshot(self):
+        return getattr(self._snapshots, 'current', None)
+
+    def start_snapshot(self, definition_pks):
+        """
+        Retrieve the checksums of `definition_pks` at once and trust them, as
+        well as the ones retrieved afterwards, in the current thread until
+        `end_snapshot` is called.
+        """
+        self._snapshots.current = None
+        self._snapshots.current = self.get_checksums(list(definition_pks))
+
+    def end_snapshot(self):
+        self._snapshots.current = None
+
+    @contextmanager
+    def snapshot(self, definition_pks):
+        if self.get_snapshot() is not None:
+            # Nested snapshots are part of the outer unit of work.
+            yield
+            return
+        self.start_snapshot(definition_pks)
+        try:
+            yield
+        finally:
+            self.end_snapshot()
+
+    def get_checksum(self, definition_pk):
+        snapshot = self.get_snapshot()
+        if snapshot is None:
+            return self.get_handler().get_checksum(definition_pk)
+        try:
+            return snapshot[definition_pk]
+        except KeyError:
+            checksum = snapshot[definition_pk] = self.get_handler().get_checksum(definition_pk)
+            return checksum
+
+    def get_checksums(self, definition_pks):
+        """
+        Retrieve the checksums of multiple definitions at once, falling back
+        to individual retrievals for handlers that don't support it.
+        """
+        snapshot = self.get_snapshot()
+        if snapshot is None:
+            snapshot = {}
+        checksums = dict(
+            (definition_pk, snapshot[definition_pk]) for definition_pk in definition_pks
+            if definition_pk in snapshot
+        )
+        missing = [definition_pk for definition_pk in definition_pks if definition_pk not in checksums]
+        if missing:
+            handler = self.get_handler()
+            try:
+                get_checksums = handler.get_checksums
+            except AttributeError:
+                retrieved = dict(
+                    (definition_pk, handler.get_checksum(definition_pk)) for definition_pk in missing
+                )
+            else:
+                retrieved = get_checksums(missing)
+            snapshot.update(retrieved)
+            checksums.update(retrieved)
+        return checksums
+
+    def set_checksum(self, definition_pk, checksum):
+        snapshot = self.get_snapshot()
+        if snapshot is not None:
+            snapshot[definition_pk] = checksum
+        return self.get_handler().set_checksum(definition_pk, checksum)
+
+    def set_checksums(self, checksums):
+        snapshot = self.get_snapshot()
+        if snapshot is not None:
+            snapshot.update(checksums)
+        handler = self.get_handler()
         try:
-            handler = getattr(handlers, path)
+            set_checksums = handler.set_checksums
         except AttributeError:
-            handler = import_string(path)()
-            setattr(handlers, path, handler)
-        return getattr(handler, name)
+            for definition_pk, checksum in checksums.items():
+                handler.set_checksum(definition_pk, checksum)
+        else:
+            set_checksums(checksums)
+
+    def clear_checksum(self, definition_pk):
+        snapshot = self.get_snapshot()
+        if snapshot is not None:
+            snapshot[definition_pk] = None
+        return self.get_handler().clear_checksum(definition_pk)
+
+    def __getattr__(self, name):
+        if name in ('_handlers', '_handler', '_lock', '_fork_lock', '_forking', '_path', '_pid', '_snapshots'):
+            raise AttributeError(name)
+        return getattr(self.get_handler(), name)
@@ -1,22 +1,33 @@
 from __future__ import unicode_literals
 
-from collections import defaultdict
+import datetime
+import hashlib
+import re
 from contextlib import contextmanager
-from copy import deepcopy
+from decimal import Decimal
 from itertools import chain, groupby
 from operator import itemgetter
+from threading import local, Lock
+from types import BuiltinFunctionType, FunctionType, MethodType
+from uuid import UUID
 
-from django.apps import AppConfig, apps
+from django.apps import apps
 from django.db import connections, models, router
 from django.utils import six
 from django.utils.encoding import force_text
-from django.utils.functional import lazy
+from django.utils.functional import lazy, Promise
 
 from .compat import (
     clear_opts_related_cache, get_remote_field, get_remote_field_accessor_name,
     get_remote_field_model,
 )
 
+# The algorithm must be available on every supported Python version since
+# checksums are compared across processes.
+CHECKSUM_ALGORITHM = 'sha256'
+# Bump when the canonical representation of values changes.
+CHECKSUM_VERSION = 2
+
 
 def allow_migrate(model):
     for db in connections:
@@ -73,6 +84,66 @@ def apps_lock():
         yield
 
 
+_bulk_update = local()
+# Number of threads within an `apps_bulk_update` block and the `clear_cache`
+# instance attribute of the registry to restore once none of them are.
+_bulk_update_lock = Lock()
+_bulk_update_threads = 0
+_registry_clear_cache = None
+
+
+def _clear_cache():
+    if getattr(_bulk_update, 'depth', 0):
+        # Models retrieval must reflect the registered models.
+        apps.get_models.cache_clear()
+        _bulk_update.pending = True
+    else:
+        type(apps).clear_cache(apps)
+
+
+def _install_clear_cache():
+    global _bulk_update_threads, _registry_clear_cache
+    with _bulk_update_lock:
+        if not _bulk_update_threads:
+            _registry_clear_cache = apps.__dict__.get('clear_cache')
+            apps.clear_cache = _clear_cache
+        _bulk_update_threads += 1
+
+
+def _uninstall_clear_cache():
+    global _bulk_update_threads, _registry_clear_cache
+    with _bulk_update_lock:
+        _bulk_update_threads -= 1
+        if not _bulk_update_threads:
+            if _registry_clear_cache is None:
+                del apps.clear_cache
+            else:
+                apps.clear_cache = _registry_clear_cache
+                _registry_clear_cache = None
+
+
+@contextmanager
+def apps_bulk_update():
+    """
+    Defer the expiry of all models options cache the app registry performs
+    every time a model is registered by the current thread until the context
+    is exited.
+    """
+    depth = getattr(_bulk_update, 'depth', 0)
+    if not depth:
+        _install_clear_cache()
+    _bulk_update.depth = depth + 1
+    try:
+        yield
+    finally:
+        _bulk_update.depth = depth
+        if not depth:
+            _uninstall_clear_cache()
+            if getattr(_bulk_update, 'pending', False):
+                _bulk_update.pending = False
+                apps.clear_cache()
+
+
 def remove_from_app_cache(model_class, quiet=False):
     opts = model_class._meta
     apps = opts.apps
@@ -83,7 +154,11 @@ def remove_from_app_cache(model_class, quiet=False):
         except KeyError:
             if not quiet:
                 raise ValueError("%r is not cached" % model_class)
-        apps.clear_cache()
+        # Only the options of the removed model and of the ones it points to
+        # (expired by `unreference_model`) refer to it; there's no need to
+        # expire the caches of all installed models like `clear_cache` does.
+        apps.get_models.cache_clear()
+        clear_opts_related_cache(model_class)
         unreference_model(model_class)
     return model_class
 
@@ -120,25 +195,33 @@ def unreference_model(model):
                             raise
 
 
-class Empty(object):
-    pass
+def expire_model_caches(model_class):
+    """
+    Expire the options cache of `model_class` and of the models it points to.
+    """
+    remote_models = set()
+    for field in get_foward_fields(model_class._meta):
+        if get_remote_field(field):
+            remote_field_model = get_remote_field_model(field)
+            if isinstance(remote_field_model, models.base.ModelBase):
+                remote_models.add(remote_field_model)
+    clear_opts_related_cache(model_class)
+    for remote_model in remote_models:
+        clear_opts_related_cache(remote_model)
 
 
-def _app_cache_deepcopy(obj):
+def _app_cache_copy(obj):
     """
-    An helper that correctly deepcopy model cache state
+    Copy the app registry containers without copying the app configs and
+    models they hold.
     """
-    if isinstance(obj, defaultdict):
-        return deepcopy(obj)
-    elif isinstance(obj, dict):
-        return type(obj)((_app_cache_deepcopy(key), _app_cache_deepcopy(val)) for key, val in obj.items())
+    if isinstance(obj, dict):
+        copy = obj.copy()
+        for key, val in copy.items():
+            copy[key] = _app_cache_copy(val)
+        return copy
     elif isinstance(obj, list):
-        return list(_app_cache_deepcopy(val) for val in obj)
-    elif isinstance(obj, AppConfig):
-        app_conf = Empty()
-        app_conf.__class__ = AppConfig
-        app_conf.__dict__ = _app_cache_deepcopy(obj.__dict__)
-        return app_conf
+        return list(obj)
     return obj
 
 
@@ -147,18 +230,125 @@ def app_cache_restorer():
     """
     A context manager that restore model cache state as it was before
     entering context.
+
+    Only the models registered or removed in the context have their options
+    cache, and the one of the models they point to, expired on exit.
     """
-    state = _app_cache_deepcopy(apps.__dict__)
+    state = _app_cache_copy(apps.__dict__)
+    all_models = state['all_models']
     try:
         yield state
     finally:
         with apps_lock():
+            changed_models = set()
+            for app_label, app_models in apps.all_models.items():
+                original_models = all_models.get(app_label, {})
+                for model_name, model in app_models.items():
+                    if original_models.get(model_name) is not model:
+                        changed_models.add(model)
+                for model_name, model in original_models.items():
+                    if app_models.get(model_name) is not model:
+                        changed_models.add(model)
             apps.__dict__ = state
             # Rebind the app registry models cache to
             # individual app config ones.
             for app_conf in apps.get_app_configs():
                 app_conf.models = apps.all_models[app_conf.label]
-            apps.clear_cache()
+            apps.get_models.cache_clear()
+            for model in changed_models:
+                expire_model_caches(model)
+
+
+# Types whose representation only depends on their value.
+_stable_repr_types = (datetime.date, datetime.time, datetime.timedelta, Decimal, UUID)
+_pattern_type = type(re.compile(''))
+
+
+def _qualified_name(obj):
+    # `__qualname__` is not available on Python 2.
+    return "%s.%s" % (obj.__module__, obj.__name__)
+
+
+def _canonical_repr(value, write):
+    if value is None or isinstance(value, bool):
+        write("%s" % value)
+    elif isinstance(value, six.integer_types):
+        write("%d" % value)
+    elif isinstance(value, float):
+        write(repr(value))
+    elif isinstance(value, (six.text_type, six.binary_type)):
+        value = force_text(value)
+        write("s%d:" % len(value))
+        write(value)
+    elif isinstance(value, Promise):
+        # Lazy objects are represented by the arguments they were created
+        # with to prevent the active language from leaking in.
+        write('lazy(')
+        _canonical_repr(value._proxy____args, write)
+        _canonical_repr(value._proxy____kw, write)
+        write(')')
+    elif isinstance(value, (list, tuple)):
+        write('[' if isinstance(value, list) else '(')
+        for item in value:
+            _canonical_repr(item, write)
+            write(',')
+        write(']' if isinstance(value, list) else ')')
+    elif isinstance(value, dict):
+        write('{')
+        for key, item in sorted((canonical_repr(key), canonical_repr(item)) for key, item in value.items()):
+            write(key)
+            write(':')
+            write(item)
+            write(',')
+        write('}')
+    elif isinstance(value, (set, frozenset)):
+        write('set(')
+        for item in sorted(canonical_repr(item) for item in value):
+            write(item)
+            write(',')
+        write(')')
+    elif isinstance(value, (type, FunctionType, BuiltinFunctionType)):
+        write(_qualified_name(value))
+    elif isinstance(value, MethodType):
+        write("%s.%s" % (canonical_repr(value.__self__), value.__name__))
+    elif hasattr(value, 'deconstruct'):
+        write(_qualified_name(value.__class__))
+        _canonical_repr(value.deconstruct(), write)
+    elif isinstance(value, _stable_repr_types):
+        write(_qualified_name(value.__class__))
+        write(repr(value))
+    elif isinstance(value, _pattern_type):
+        write('re(')
+        _canonical_repr(value.pattern, write)
+        _canonical_repr(value.flags, write)
+        write(')')
+    else:
+        # The representation of arbitrary objects might embed their address
+        # or depend on an iteration order which would result in checksums
+        # differing between processes.
+        raise TypeError("Cannot compute the canonical representation of %r." % value)
+
+
+def canonical_repr(value):
+    """
+    Return a text representation of `value` that only depends on its content.
+
+    Unlike pickle, the representation doesn't depend on the Python version,
+    the pickle protocol or the iteration order of dicts and sets.
+    """
+    parts = []
+    _canonical_repr(value, parts.append)
+    return ''.join(parts)
+
+
+def get_checksum(value):
+    """
+    Return a checksum of the canonical representation of `value` tagged
+    with the algorithm and representation version used to compute it.
+    """
+    # Truncated to 128 bits to fit in the stored checksum columns.
+    digest = hashlib.sha256(canonical_repr(value).encode('utf-8')).hexdigest()[:32]
+    return "%s$%d$%s" % (CHECKSUM_ALGORITHM, CHECKSUM_VERSION, digest)
 
 
 group_item_getter = itemgetter('group')
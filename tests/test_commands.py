@@ -3,6 +3,7 @@ from __future__ import unicode_literals
 import json
 from tempfile import NamedTemporaryFile
 
+from django.apps import apps
 from django.core.management import call_command
 from django.core.serializers.base import DeserializationError
 from django.core.serializers.json import Serializer as JSONSerializer
@@ -53,6 +54,21 @@ class DumpDataTestCase(DataCommandTestCase):
         )
 
 
+class WarmModelClassesTestCase(DataCommandTestCase):
+    def test_warm_model_classes(self):
+        """
+        Make sure model classes are constructed and timings are reported.
+        """
+        remove_from_app_cache(self.model_cls)
+        output = StringIO()
+        call_command('warm_model_classes', 'mutant', stdout=output)
+        self.assertIsNotNone(
+            apps.get_app_config('mutant').models.get(self.model_def.model)
+        )
+        phases = [line.split(':')[0] for line in output.getvalue().splitlines()]
+        self.assertEqual(phases, ['load', 'order', 'render'])
+
+
 class BytesWritter(object):
     def __init__(self, stream):
         self._stream = stream
@@ -1,25 +1,35 @@
 from __future__ import unicode_literals
 
+import shutil
+import tempfile
 from unittest import skip
 
 from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import ValidationError
 from django.core.management import call_command
+from django.db import connection
 from django.db.models.deletion import ProtectedError
 from django.db.models.fields import FieldDoesNotExist
+from django.test.utils import CaptureQueriesContext
 from django.utils.translation import ugettext_lazy as _
 
+from mutant import settings
 from mutant.compat import (
     get_related_model, get_remote_field_model, get_reverse_fields,
 )
 from mutant.contrib.related.models import (
-    ForeignKeyDefinition, ManyToManyFieldDefinition,
+    DependencyEdge, ForeignKeyDefinition, ManyToManyFieldDefinition,
 )
+from mutant.contrib.text.models import CharFieldDefinition
+from mutant.db.models import model_class_cache, MutableModel
 from mutant.models import ModelDefinition
+from mutant.models.model.cache import model_state_cache
+from mutant.models.model.managers import sort_by_dependencies
+from mutant.state import handler as state_handler
 from mutant.test.testcases import FieldDefinitionTestMixin
-from mutant.utils import app_cache_restorer
+from mutant.utils import app_cache_restorer, remove_from_app_cache
 
-from .utils import BaseModelDefinitionTestCase
+from .utils import BaseModelDefinitionTestCase, CountingStateHandler
 
 
 class RelatedFieldDefinitionTestMixin(FieldDefinitionTestMixin):
@@ -66,6 +76,40 @@ class ForeignKeyDefinitionTest(RelatedFieldDefinitionTestMixin,
         super(ForeignKeyDefinitionTest, self).test_field_deletion()
         self.assertFalse(has_reverse_field_on_ct(self.model_def.model_class()))
 
+    def test_model_class_cache_dependencies(self):
+        """Make sure referenced classes are not evicted and evictions are
+        deferred until constructions complete."""
+        second_model_def = ModelDefinition.objects.create(
+            app_label='related', object_name='SecondModel'
+        )
+        ForeignKeyDefinition.objects.create(
+            model_def=self.model_def,
+            name='second',
+            null=True,
+            to=second_model_def,
+        )
+        third_model_def = ModelDefinition.objects.create(
+            app_label='related', object_name='ThirdModel'
+        )
+        size = model_class_cache.size
+        model_class_cache.size = 3
+        try:
+            second_model_class = second_model_def.model_class(force_create=True).model
+            first_model_class = self.model_def.model_class(force_create=True).model
+            model_class_cache.size = 1
+            evictions = model_class_cache.evictions
+            with model_class_cache.deferring():
+                third_model_def.model_class(force_create=True)
+                self.assertEqual(model_class_cache.evictions, evictions)
+            self.assertEqual(model_class_cache.evictions, evictions + 1)
+            self.assertFalse(second_model_class._is_evicted)
+            self.assertTrue(first_model_class._is_evicted)
+            self.assertFalse(first_model_class.is_obsolete())
+            self.assertIs(self.model_def.model_class().second.field.related_model, second_model_class)
+        finally:
+            model_class_cache.size = size
+            model_class_cache.clear()
+
     def test_foreign_key_between_mutable_models(self):
         first_model_def = self.model_def
         second_model_def = ModelDefinition.objects.create(
@@ -124,6 +168,181 @@ class ForeignKeyDefinitionTest(RelatedFieldDefinitionTestMixin,
         self.assertEqual(FirstModel.objects.get(second_set=second), first)
         second_model_def.delete()
 
+    def test_dependency_edges(self):
+        """Make sure dependency edges are maintained on field definition
+        changes and allow to determine the blast radius of a change."""
+        second_model_def = ModelDefinition.objects.create(
+            app_label='related', object_name='SecondModel'
+        )
+        third_model_def = ModelDefinition.objects.create(
+            app_label='related', object_name='ThirdModel'
+        )
+        fk = ForeignKeyDefinition.objects.create(
+            model_def=second_model_def, name='first', null=True, to=self.model_def
+        )
+        ForeignKeyDefinition.objects.create(
+            model_def=third_model_def, name='second', null=True, to=second_model_def
+        )
+        self.assertEqual(DependencyEdge.objects.referrers([self.model_def.pk]), set([second_model_def.pk]))
+        self.assertEqual(
+            DependencyEdge.objects.blast_radius(self.model_def.pk),
+            set([second_model_def.pk, third_model_def.pk])
+        )
+        fk.delete()
+        self.assertEqual(DependencyEdge.objects.blast_radius(self.model_def.pk), set())
+        self.assertEqual(DependencyEdge.objects.blast_radius(second_model_def.pk), set([third_model_def.pk]))
+        model_def_pks = [second_model_def.pk, third_model_def.pk]
+        third_model_def.delete()
+        second_model_def.delete()
+        self.assertFalse(DependencyEdge.objects.filter(model_def_id__in=model_def_pks).exists())
+
+    def test_lazy_related_models(self):
+        """Make sure referring model classes are not constructed on class
+        preparation when related models are lazily constructed."""
+        referencing_model_def = ModelDefinition.objects.create(
+            app_label='related', object_name='ReferencingModel'
+        )
+        ForeignKeyDefinition.objects.create(
+            model_def=referencing_model_def, name='fk', null=True, to=self.model_def,
+            related_name='referencings'
+        )
+        lazy_related_models = settings.LAZY_RELATED_MODELS
+        settings.LAZY_RELATED_MODELS = True
+        try:
+            # Simulate a process that didn't construct the referring class.
+            remove_from_app_cache(referencing_model_def.model_class().model)
+            model_class = self.model_def.model_class(force_create=True).model
+            self.assertIn(
+                (ModelDefinition, referencing_model_def.pk), model_class._deferred_dependencies
+            )
+            self.assertFalse(hasattr(model_class, 'referencings'))
+            referencing_model_class = referencing_model_def.model_class()
+            self.assertTrue(hasattr(model_class, 'referencings'))
+            referencing_model_class.objects.create(fk=model_class.objects.create())
+            # Deletion should cascade even if the referring model class was
+            # not constructed.
+            remove_from_app_cache(referencing_model_class.model)
+            model_class = self.model_def.model_class(force_create=True).model
+            self.assertFalse(hasattr(model_class, 'referencings'))
+            model_class.objects.get().delete()
+            self.assertFalse(referencing_model_class.objects.exists())
+        finally:
+            settings.LAZY_RELATED_MODELS = lazy_related_models
+        referencing_model_def.delete()
+
+    def test_lazy_related_models_cascade(self):
+        """Make sure queryset deletions and cascades construct the deferred
+        referring model classes to collect their instances."""
+        second_model_def = ModelDefinition.objects.create(
+            app_label='related', object_name='SecondModel'
+        )
+        ForeignKeyDefinition.objects.create(model_def=second_model_def, name='first', to=self.model_def)
+        third_model_def = ModelDefinition.objects.create(
+            app_label='related', object_name='ThirdModel'
+        )
+        ForeignKeyDefinition.objects.create(model_def=third_model_def, name='second', to=second_model_def)
+        ThirdModel = third_model_def.model_class()
+        ThirdModel.objects.create(
+            second=second_model_def.model_class().objects.create(first=self.model_def.model_class().objects.create())
+        )
+        lazy_related_models = settings.LAZY_RELATED_MODELS
+        settings.LAZY_RELATED_MODELS = True
+        try:
+            # Simulate a process that didn't construct the referring classes.
+            remove_from_app_cache(ThirdModel.model)
+            remove_from_app_cache(second_model_def.model_class().model)
+            model_class = self.model_def.model_class(force_create=True).model
+            self.assertEqual(
+                model_class._deferred_dependencies, set([(ModelDefinition, second_model_def.pk)])
+            )
+            model_class.objects.all().delete()
+            self.assertFalse(second_model_def.model_class().objects.exists())
+            self.assertFalse(ThirdModel.objects.exists())
+        finally:
+            settings.LAZY_RELATED_MODELS = lazy_related_models
+        third_model_def.delete()
+        second_model_def.delete()
+
+    def test_model_state_cache_relationships(self):
+        """Make sure the mutable models referenced by a model class
+        constructed from its cached state are constructed."""
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        model_state_cache.directory = directory
+        try:
+            second_model_def = ModelDefinition.objects.create(
+                app_label='related', object_name='SecondModel'
+            )
+            ForeignKeyDefinition.objects.create(
+                model_def=second_model_def, name='first', null=True, to=self.model_def
+            )
+            ForeignKeyDefinition.objects.create(
+                model_def=self.model_def, name='second', null=True, to=second_model_def,
+                related_name='firsts'
+            )
+            second_checksum = second_model_def.model_class().checksum()
+            self.assertIsNotNone(model_state_cache.get(second_model_def.pk, second_checksum))
+            self.assertIsNotNone(model_state_cache.get(self.model_def.pk, self.model_def.model_class().checksum()))
+            # Simulate a restarting process.
+            remove_from_app_cache(second_model_def.model_class().model)
+            remove_from_app_cache(self.model_def.model_class().model)
+            SecondModel = ModelDefinition.objects.get(pk=second_model_def.pk).model_class()
+            FirstModel = self.model_def.model_class()
+            self.assertEqual(SecondModel.checksum(), second_checksum)
+            self.assertIs(SecondModel._meta.get_field('first').related_model, FirstModel.model)
+            self.assertIs(FirstModel._meta.get_field('second').related_model, SecondModel.model)
+            first = FirstModel.objects.create()
+            second = SecondModel.objects.create(first=first)
+            self.assertEqual(SecondModel.objects.select_related('first').get(first__pk=first.pk), second)
+        finally:
+            model_state_cache.directory = None
+        second_model_def.delete()
+
+    def test_render_state_cache(self):
+        """Make sure rendered states are cached until a referenced mutable
+        model is altered."""
+        other_model_def = ModelDefinition.objects.create(
+            app_label='related', object_name='OtherModel'
+        )
+        ForeignKeyDefinition.objects.create(
+            model_def=self.model_def, name='other', null=True, to=other_model_def
+        )
+        model_class = self.model_def.model_class().model
+        rendered = model_class.render_state()
+        self.assertIs(model_class.render_state(), rendered)
+        CharFieldDefinition.objects.create(
+            model_def=other_model_def, name='field', max_length=10
+        )
+        self.assertIsNot(model_class.render_state(), rendered)
+        other_model_def.delete()
+
+    def test_render_state_field_changes(self):
+        """Make sure rendered states are derived from the previous one on
+        field changes instead of being rendered again."""
+        render_state = MutableModel.__dict__['_render_state']
+        renders = []
+
+        def _render_state(cls):
+            renders.append(cls)
+            return render_state.__func__(cls)
+        MutableModel._render_state = classmethod(_render_state)
+        try:
+            for i in range(5):
+                CharFieldDefinition.objects.create(model_def=self.model_def, name="field%d" % i, max_length=10)
+            self.assertEqual(len(renders), 1)
+            field_def = CharFieldDefinition.objects.get(model_def=self.model_def, name='field0')
+            field_def.name = 'renamed'
+            field_def.save()
+            field_def.delete()
+            self.assertEqual(len(renders), 1)
+            opts = self.model_def.model_class().render_state()._meta
+            self.assertEqual(
+                [field.name for field in opts.local_fields],
+                [field.name for field in self.model_def.model_class()._meta.local_fields],
+            )
+        finally:
+            MutableModel._render_state = render_state
+
     def test_recursive_relationship(self):
         fk = ForeignKeyDefinition.objects.create(
             model_def=self.model_def, name='f1', null=True, blank=True,
@@ -166,6 +385,101 @@ class ForeignKeyDefinitionTest(RelatedFieldDefinitionTestMixin,
         with self.assertRaises(from_model_class.DoesNotExist):
             from_model_class.objects.get(pk=from_instance.pk)
 
+    def test_warm_model_classes_ordering(self):
+        """Make sure definitions are constructed after the ones they refer
+        to when warming model classes."""
+        referencing_model_def = ModelDefinition.objects.create(
+            app_label='related', object_name='ReferencingModel'
+        )
+        ForeignKeyDefinition.objects.create(
+            model_def=self.model_def, name='referencing', null=True,
+            to=referencing_model_def
+        )
+        ForeignKeyDefinition.objects.create(
+            model_def=referencing_model_def, name='recursive', null=True,
+            to=referencing_model_def
+        )
+        model_defs = ModelDefinition.objects.filter(
+            pk__in=[self.model_def.pk, referencing_model_def.pk]
+        ).order_by('pk').prefetch_state()
+        self.assertEqual(
+            sort_by_dependencies(model_defs), [referencing_model_def, self.model_def]
+        )
+        for model_def in model_defs:
+            remove_from_app_cache(model_def.model_class()).mark_as_obsolete()
+        timings = ModelDefinition.objects.warm_model_classes(model_defs)
+        self.assertEqual(list(timings), ['load', 'order', 'render'])
+        Model = self.model_def.model_class()
+        self.assertEqual(
+            get_remote_field_model(Model._meta.get_field('referencing')),
+            referencing_model_def.model_class()
+        )
+        referencing_model_def.delete()
+
+    def test_warm_model_classes_referrers(self):
+        """Make sure the referrers of warmed definitions are constructed from
+        their prefetched state."""
+        referencing_model_defs = []
+        for i in range(3):
+            model_def = ModelDefinition.objects.create(
+                app_label='related', object_name="ReferencingModel%d" % i
+            )
+            ForeignKeyDefinition.objects.create(
+                model_def=model_def, name='fk', null=True, to=self.model_def
+            )
+            referencing_model_defs.append(model_def)
+        model_defs = [self.model_def] + referencing_model_defs
+        for model_def in model_defs:
+            remove_from_app_cache(model_def.model_class()).mark_as_obsolete()
+        with CaptureQueriesContext(connection) as captured_queries:
+            ModelDefinition.objects.warm_model_classes(
+                ModelDefinition.objects.filter(pk__in=[model_def.pk for model_def in model_defs])
+            )
+        field_definition_queries = [
+            query for query in captured_queries if 'FROM "mutant_fielddefinition"' in query['sql']
+        ]
+        self.assertEqual(len(field_definition_queries), 1)
+        Model = self.model_def.model_class()
+        for model_def in referencing_model_defs:
+            self.assertIn((ModelDefinition, model_def.pk), Model._dependencies)
+            self.assertEqual(get_remote_field_model(model_def.model_class()._meta.get_field('fk')), Model)
+        for model_def in referencing_model_defs:
+            model_def.delete()
+
+    def test_mark_as_obsolete_dependencies(self):
+        """Make sure the dependencies of an obsolete model are marked as
+        obsolete without retrieving their definition or checksum."""
+        referencing_model_defs = []
+        for object_name in ('FirstReferencingModel', 'SecondReferencingModel'):
+            model_def = ModelDefinition.objects.create(
+                app_label='related', object_name=object_name
+            )
+            ForeignKeyDefinition.objects.create(
+                model_def=model_def, name='fk', null=True, to=self.model_def
+            )
+            referencing_model_defs.append(model_def)
+        # Make the first referencing model depend on the second one.
+        ForeignKeyDefinition.objects.create(
+            model_def=referencing_model_defs[1], name='first', null=True, to=referencing_model_defs[0]
+        )
+        model_class = self.model_def.model_class().model
+        referencing_model_classes = [
+            model_def.model_class().model for model_def in referencing_model_defs
+        ]
+        path = state_handler.path
+        state_handler.path = 'tests.utils.CountingStateHandler'
+        try:
+            CountingStateHandler.retrievals = 0
+            with self.assertNumQueries(0):
+                model_class.mark_as_obsolete()
+            self.assertEqual(CountingStateHandler.retrievals, 0)
+        finally:
+            state_handler.path = path
+        for referencing_model_class in referencing_model_classes:
+            self.assertTrue(referencing_model_class.is_obsolete())
+        for model_def in reversed(referencing_model_defs):
+            model_def.delete()
+
 
 class ForeignKeyDefinitionOnDeleteTest(BaseModelDefinitionTestCase):
     def test_protect(self):
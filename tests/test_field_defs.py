@@ -4,8 +4,11 @@ import warnings
 
 from django.apps.registry import Apps
 from django.core.exceptions import ValidationError
+from django.db import connections, router
 from django.test import SimpleTestCase
+from django.test.utils import CaptureQueriesContext
 
+import mutant
 from mutant.contrib.numeric.models import IntegerFieldDefinition
 from mutant.contrib.text.models import CharFieldDefinition
 from mutant.models.field import (
@@ -158,3 +161,46 @@ class FieldDefinitionManagerTest(BaseModelDefinitionTestCase):
         self.assertEqual(
             FieldDefinition.objects.get_by_natural_key(*natural_key), fd
         )
+
+
+class BatchSchemaChangesTest(BaseModelDefinitionTestCase):
+    def create_field_defs(self, count):
+        for i in range(count):
+            CharFieldDefinition.objects.create(
+                model_def=self.model_def, name="field%d" % i, max_length=10, null=True
+            )
+
+    def test_batching(self):
+        """Make sure schema alterations are only applied when the block
+        exits."""
+        connection = connections[router.db_for_write(self.model_def.model_class())]
+        with CaptureQueriesContext(connection) as captured_queries:
+            with mutant.batch_schema_changes():
+                self.create_field_defs(3)
+                with mutant.batch_schema_changes():
+                    CharFieldDefinition.objects.get(model_def=self.model_def, name='field0').delete()
+                model_class = self.model_def.model_class()
+                self.assertModelTablesColumnDoesntExists(model_class, 'field1')
+        for column in ('field1', 'field2'):
+            self.assertModelTablesColumnExists(model_class, column)
+        self.assertModelTablesColumnDoesntExists(model_class, 'field0')
+        model_class.objects.create(field1='value')
+        if connection.vendor == 'sqlite':
+            # Additions are merged in a single table rebuild.
+            tables_creations = [
+                query for query in captured_queries if query['sql'].startswith('CREATE TABLE')
+            ]
+            self.assertEqual(len(tables_creations), 2)
+
+    def test_exception_applies_changes(self):
+        """Make sure the tables reflect the definitions saved in the block
+        when an exception is raised."""
+        with self.assertRaises(ValueError):
+            with mutant.batch_schema_changes():
+                self.create_field_defs(1)
+                raise ValueError
+        model_class = self.model_def.model_class()
+        self.assertIn('field0', [field.name for field in model_class._meta.fields])
+        self.assertModelTablesColumnExists(model_class, 'field0')
+        model_class.objects.create(field0='value')
+        self.assertEqual(model_class.objects.get().field0, 'value')
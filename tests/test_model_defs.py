@@ -1,30 +1,53 @@
 from __future__ import unicode_literals
 
+import gc
+import json
+import os
 import pickle
-
+import shutil
+import tempfile
+from collections import OrderedDict
+from decimal import Decimal
+from threading import Event, Thread
+from timeit import repeat
+from unittest import skipUnless
+
+from django.apps import apps
 from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import ValidationError
 from django.core.management import call_command
 from django.db import connections, models, router, transaction
 from django.db.utils import IntegrityError
 from django.test.utils import CaptureQueriesContext
+from django.utils import translation
 from django.utils.translation import ugettext as _
 
+import mutant
+from mutant import settings
 from mutant.compat import clear_opts_related_cache, get_related_model
 from mutant.contrib.related.models import ForeignKeyDefinition
 from mutant.contrib.text.models import CharFieldDefinition
-from mutant.db.models import MutableModel
+from mutant.db.models import _rendered_states, model_class_cache, MutableModel
+from mutant.models.field import FieldDefinitionChoice
 from mutant.models.model import (
-    BaseDefinition, ModelDefinition, MutableModelProxy,
+    _construction_locks, BaseDefinition, ModelDefinition, MutableModelProxy,
     OrderingFieldDefinition, UniqueTogetherDefinition,
 )
-from mutant.utils import remove_from_app_cache
+from mutant.models.model.cache import model_state_cache
+from mutant.signals import mutable_class_prepared
+from mutant.state import handler as state_handler
+from mutant.utils import (
+    canonical_repr, CHECKSUM_ALGORITHM, CHECKSUM_VERSION, get_checksum,
+    remove_from_app_cache,
+)
 
 from .models import (
     AbstractConcreteModelSubclass, AbstractModel, Mixin,
     ModelSubclassWithTextField, ProxyModel,
 )
-from .utils import BaseModelDefinitionTestCase
+from .utils import (
+    benchmark, BaseModelDefinitionTestCase, CountingStateHandler, disabled_logger, report_benchmark,
+)
 
 # Remove when dropping support for Python 2
 try:
@@ -33,6 +56,20 @@ except ImportError:
     from test.test_support import captured_stderr
 
 
+def get_memory_usage():
+    """
+    Return the resident and private memory of the current process in kB.
+    """
+    rss = private = 0
+    with open('/proc/self/smaps') as smaps:
+        for line in smaps:
+            if line.startswith('Rss:'):
+                rss += int(line.split()[1])
+            elif line.startswith(('Private_Clean:', 'Private_Dirty:')):
+                private += int(line.split()[1])
+    return rss, private
+
+
 class ModelDefinitionTest(BaseModelDefinitionTestCase):
     def test_model_class_creation_cache(self):
         existing_model_class = self.model_def.model_class().model
@@ -48,6 +85,259 @@ class ModelDefinitionTest(BaseModelDefinitionTestCase):
         with self.assertChecksumDoesntChange():
             self.model_def.model_class(force_create=True)
 
+    def test_checksum_persistence(self):
+        model_class = self.model_def.model_class()
+        checksum = ModelDefinition.objects.values_list('checksum', flat=True).get(pk=self.model_def.pk)
+        self.assertEqual(checksum, model_class.checksum())
+        self.assertTrue(checksum.startswith("%s$%d$" % (CHECKSUM_ALGORITHM, CHECKSUM_VERSION)))
+
+    def test_checksum_stability(self):
+        """The checksum shouldn't depend on the active language or the
+        iteration order of the options."""
+        self.model_def.verbose_name = 'MyModel'
+        self.model_def.save()
+        checksum = self.model_def.model_class().checksum()
+        with translation.override('fr'):
+            with self.assertChecksumDoesntChange():
+                self.model_def.model_class(force_create=True)
+        self.assertEqual(self.model_def.model_class().checksum(), checksum)
+        self.assertEqual(
+            canonical_repr({'a': 1, 'b': (2, 'c')}),
+            canonical_repr(OrderedDict([('b', (2, 'c')), ('a', 1)]))
+        )
+        # Checksums must be identical on every Python version.
+        self.assertEqual(
+            get_checksum([1, 'a', {'b': None}, OrderedDict]), 'sha256$2$8dea6189b060c5566f65d6207ecdd0ca'
+        )
+        self.assertEqual(canonical_repr(Decimal('1.50')), "decimal.DecimalDecimal('1.50')")
+        # Objects whose representation might differ between processes are
+        # not supported.
+        with self.assertRaises(TypeError):
+            canonical_repr([object()])
+
+    def test_stored_checksum_reuse(self):
+        """Make sure the stored checksum is trusted when the state handler
+        lost track of it."""
+        model_class = self.model_def.model_class().model
+        state_handler.clear_checksum(self.model_def.pk)
+        model_def = ModelDefinition.objects.get(pk=self.model_def.pk)
+        with self.assertNumQueries(0):
+            self.assertIs(model_def.model_class().model, model_class)
+        self.assertEqual(state_handler.get_checksum(self.model_def.pk), model_class.checksum())
+
+    def test_attribute_checksum_persistence(self):
+        """Make sure definition attributes alterations update the stored
+        checksum."""
+        field_def = CharFieldDefinition.objects.create(
+            model_def=self.model_def, name='field', max_length=10
+        )
+        FieldDefinitionChoice.objects.create(field_def=field_def, value='value', label='label')
+        self.assertEqual(ModelDefinition.objects.checksums(), {
+            self.model_def.pk: self.model_def.model_class().checksum()
+        })
+        field_def.delete()
+        self.assertEqual(ModelDefinition.objects.checksums(), {
+            self.model_def.pk: self.model_def.model_class().checksum()
+        })
+
+    def test_field_patching(self):
+        """Make sure field changes patch the existing model class into the
+        same state a full rebuild would produce."""
+        field_def = CharFieldDefinition.objects.create(
+            model_def=self.model_def, name='field', max_length=10
+        )
+        model_class = self.model_def.model_class().model
+        field_def.max_length = 20
+        field_def.save()
+        patched_model_class = self.model_def.model_class().model
+        self.assertIsNot(patched_model_class, model_class)
+        self.assertTrue(model_class._is_obsolete)
+        self.assertEqual(patched_model_class._meta.get_field('field').max_length, 20)
+        self.assertEqual(
+            patched_model_class.checksum(), self.model_def.model_class(force_create=True).checksum()
+        )
+        field_def.name = 'renamed'
+        field_def.save()
+        self.assertEqual(
+            [field.name for field in self.model_def.model_class()._meta.fields], ['id', 'renamed']
+        )
+        field_def.delete()
+        self.assertEqual([field.name for field in self.model_def.model_class()._meta.fields], ['id'])
+        self.assertEqual(ModelDefinition.objects.checksums(), {
+            self.model_def.pk: self.model_def.model_class(force_create=True).checksum()
+        })
+
+    def test_field_patching_queries(self):
+        """Make sure patching the model class issues less queries than
+        rebuilding it."""
+        self.add_state_attributes(0, 5)
+        field = CharFieldDefinition.objects.get(model_def=self.model_def, name='field0').construct()
+        field.max_length = 20
+        connection = connections[router.db_for_read(ModelDefinition)]
+        with CaptureQueriesContext(connection) as patch_queries:
+            patched_model_class = self.model_def.patch_model_class('field0', ('field0', field))
+        self.assertIsNotNone(patched_model_class)
+        with CaptureQueriesContext(connection) as render_queries:
+            model_class = self.model_def.model_class(force_create=True)
+        self.assertLess(len(patch_queries), len(render_queries))
+        self.assertEqual(patched_model_class.checksum(), model_class.checksum())
+
+    def test_field_patching_fallback(self):
+        """Make sure changes that might affect other parts of the state are
+        not patched."""
+        field_def = CharFieldDefinition.objects.create(
+            model_def=self.model_def, name='field', max_length=10
+        )
+        self.model_def.model_class()
+        foreign_key = models.ForeignKey('contenttypes.ContentType', on_delete=models.CASCADE)
+        foreign_key.set_attributes_from_name('content_type')
+        self.assertIsNone(self.model_def.patch_model_class(added=('content_type', foreign_key)))
+        unique_together = UniqueTogetherDefinition.objects.create(model_def=self.model_def)
+        unique_together.field_defs.add(field_def)
+        self.assertIsNone(self.model_def.patch_model_class('field', ('renamed', field_def.construct())))
+        field_def.name = 'renamed'
+        field_def.save()
+        self.assertEqual(
+            self.model_def.model_class()._meta.unique_together, (('renamed',),)
+        )
+
+    def test_deferred_regeneration(self):
+        """Make sure model classes are regenerated once at the end of a
+        `defer_model_class_regeneration` block."""
+        field_def = CharFieldDefinition.objects.create(
+            model_def=self.model_def, name='field', max_length=10
+        )
+        model_class = self.model_def.model_class().model
+        prepared = []
+
+        def receiver(sender, **kwargs):
+            prepared.append(sender)
+        mutable_class_prepared.connect(receiver)
+        try:
+            with mutant.defer_model_class_regeneration():
+                for i in range(5):
+                    FieldDefinitionChoice.objects.create(
+                        field_def=field_def, value="value%d" % i, label="label%d" % i
+                    )
+                OrderingFieldDefinition.objects.create(model_def=self.model_def, lookup='field')
+                self.assertIs(self.model_def.model_class().model, model_class)
+        finally:
+            mutable_class_prepared.disconnect(receiver)
+        self.assertEqual(len(prepared), 1)
+        model_class = self.model_def.model_class()
+        self.assertEqual(len(model_class._meta.get_field('field').choices), 5)
+        self.assertEqual(model_class._meta.ordering, ('field',))
+        self.assertEqual(ModelDefinition.objects.checksums(), {
+            self.model_def.pk: model_class.checksum()
+        })
+
+    def test_deferred_regeneration_exception(self):
+        """Make sure model classes altered in a failing
+        `defer_model_class_regeneration` block are regenerated and their
+        state published."""
+        OrderingFieldDefinition.objects.create(model_def=self.model_def, lookup='id')
+        model_class = self.model_def.model_class().model
+        with self.assertRaises(ValueError):
+            with mutant.defer_model_class_regeneration():
+                OrderingFieldDefinition.objects.create(model_def=self.model_def, lookup='-id')
+                raise ValueError
+        # Other processes must observe the persisted alterations.
+        checksum = state_handler.get_checksum(self.model_def.pk)
+        self.assertNotEqual(checksum, model_class._checksum)
+        self.assertEqual(ModelDefinition.objects.checksums(), {self.model_def.pk: checksum})
+        self.assertTrue(model_class.is_obsolete())
+        regenerated_model_class = self.model_def.model_class().model
+        self.assertEqual(regenerated_model_class._checksum, checksum)
+        self.assertEqual(regenerated_model_class._meta.ordering, ('id', '-id'))
+
+    def test_model_class_cache(self):
+        """Make sure the least recently used model classes are evicted and
+        transparently constructed again on access."""
+        size = model_class_cache.size
+        model_class_cache.size = 2
+        try:
+            first_model_def = ModelDefinition.objects.create(
+                app_label='mutant', object_name='FirstModel'
+            )
+            first_proxy = first_model_def.model_class()
+            first_model_class = first_proxy.model
+            instance = first_proxy.objects.create()
+            first_model_class.render_state()
+            self.assertIn(first_model_class._definition, _rendered_states)
+            ModelDefinition.objects.create(app_label='mutant', object_name='SecondModel')
+            hits, misses, evictions = model_class_cache.hits, model_class_cache.misses, model_class_cache.evictions
+            self.model_def.model_class(force_create=True)
+            self.assertEqual(len(model_class_cache), 2)
+            self.assertEqual(model_class_cache.evictions, evictions + 1)
+            self.assertTrue(first_model_class._is_evicted)
+            self.assertFalse(first_model_class.is_obsolete())
+            self.assertNotIn(first_model_def.model, apps.all_models['mutant'])
+            self.assertNotIn(first_model_class._definition, _rendered_states)
+            # Instances loaded before their class was evicted are still usable.
+            instance.save()
+            self.model_def.model_class()
+            self.assertEqual(model_class_cache.hits, hits + 1)
+            # The proxy should construct the evicted model class again.
+            self.assertEqual(first_proxy.objects.count(), 1)
+            self.assertIsNot(first_proxy.model, first_model_class)
+            self.assertIn(first_model_def.model, apps.all_models['mutant'])
+            self.assertEqual(model_class_cache.misses, misses + 2)
+            self.assertEqual(model_class_cache.evictions, evictions + 2)
+            instance.delete()
+            self.assertEqual(first_proxy.objects.count(), 0)
+        finally:
+            model_class_cache.size = size
+            model_class_cache.clear()
+
+    def test_model_state_cache(self):
+        """Make sure model classes can be constructed from their cached
+        state without querying the definition tables."""
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        size = model_state_cache.size
+        model_state_cache.directory, model_state_cache.size = directory, 2
+        try:
+            CharFieldDefinition.objects.create(model_def=self.model_def, name='name', max_length=10)
+            checksum = self.model_def.model_class().checksum()
+            self.assertTrue(os.path.exists(model_state_cache.get_path(self.model_def.pk, checksum)))
+            # Simulate a restarting process.
+            remove_from_app_cache(self.model_def.model_class())
+            model_def = ModelDefinition.objects.get(pk=self.model_def.pk)
+            with CaptureQueriesContext(connections['default']) as captured:
+                model_class = model_def.model_class()
+            self.assertFalse(any('fielddefinition' in query['sql'] for query in captured))
+            self.assertEqual(model_class.checksum(), checksum)
+            self.assertEqual(model_class._meta.get_field('name').max_length, 10)
+            # Corrupted entries are ignored.
+            with open(model_state_cache.get_path(model_def.pk, checksum), 'wb') as state_file:
+                state_file.write(b'corrupted')
+            remove_from_app_cache(model_class)
+            with disabled_logger():
+                model_class = ModelDefinition.objects.get(pk=model_def.pk).model_class()
+            self.assertEqual(model_class.checksum(), checksum)
+            # The least recently used entries are evicted.
+            for object_name in ('FirstModel', 'SecondModel'):
+                ModelDefinition.objects.create(app_label='mutant', object_name=object_name)
+            self.assertEqual(len(os.listdir(directory)), 2)
+            self.assertIsNone(model_state_cache.get(model_def.pk, checksum))
+        finally:
+            model_state_cache.directory, model_state_cache.size = None, size
+
+    def test_check_model_classes(self):
+        model_class = self.model_def.model_class().model
+        other_model_def = ModelDefinition.objects.create(
+            app_label='mutant', object_name='OtherModel'
+        )
+        other_model_class = other_model_def.model_class().model
+        state_handler.clear_checksum(self.model_def.pk)
+        ModelDefinition.objects.filter(pk=other_model_def.pk).update(checksum='outdated')
+        with self.assertNumQueries(1):
+            obsolete = ModelDefinition.objects.check_model_classes()
+        self.assertEqual(obsolete, set([other_model_def.pk]))
+        self.assertTrue(other_model_class.is_obsolete())
+        self.assertEqual(state_handler.get_checksum(self.model_def.pk), model_class.checksum())
+        self.assertFalse(model_class.is_obsolete())
+
     def test_repr(self):
         """Make sure ModelDefinition objects are always repr()-able."""
         repr(self.model_def)
@@ -171,6 +461,62 @@ class ModelDefinitionTest(BaseModelDefinitionTestCase):
         )
         self.assertNotEqual(other_model_def.model_ct, self.model_def.model_ct)
 
+    def add_state_attributes(self, start, stop, targets=()):
+        for i in range(start, stop):
+            field_def = CharFieldDefinition.objects.create(
+                model_def=self.model_def, name="field%d" % i, max_length=10
+            )
+            FieldDefinitionChoice.objects.create(
+                field_def=field_def, value="value%d" % i, label="label%d" % i
+            )
+            OrderingFieldDefinition.objects.create(
+                model_def=self.model_def, lookup=field_def.name
+            )
+            for j, target in enumerate(targets):
+                ForeignKeyDefinition.objects.create(
+                    model_def=self.model_def, name="related%d_%d" % (i, j), null=True, to=target,
+                    related_name='+'
+                )
+
+    def test_get_state_queries(self):
+        """Make sure the number of queries required to build the state of a
+        definition doesn't grow with its number of attributes."""
+        target_model_def = ModelDefinition.objects.create(
+            app_label='mutant', object_name='TargetModel'
+        )
+        targets = (ContentType.objects.get_for_model(ContentType), target_model_def)
+        self.add_state_attributes(0, 2, targets)
+        unique_together = UniqueTogetherDefinition.objects.create(
+            model_def=self.model_def
+        )
+        unique_together.field_defs = self.model_def.fielddefinitions.all()
+        connection = connections[router.db_for_read(ModelDefinition)]
+        with CaptureQueriesContext(connection) as captured_queries:
+            state = self.model_def.get_state()
+        self.assertEqual(len(state.fields), 6)
+        self.add_state_attributes(2, 7, targets)
+        with self.assertNumQueries(len(captured_queries)):
+            state = self.model_def.get_state()
+        self.assertEqual(len(state.fields), 21)
+
+    def test_prefetch_state(self):
+        self.add_state_attributes(0, 2)
+        unique_together = UniqueTogetherDefinition.objects.create(
+            model_def=self.model_def
+        )
+        unique_together.field_defs = self.model_def.fielddefinitions.all()
+        model_def = ModelDefinition.objects.prefetch_state().get(pk=self.model_def.pk)
+        with self.assertNumQueries(0):
+            state = model_def.get_state()
+        self.assertEqual(state.options, self.model_def.get_state().options)
+        self.assertEqual(len(state.fields), 2)
+        self.assertEqual(tuple(state.fields[0][1].choices), (('value0', 'label0'),))
+        # Prefetched attributes should only be used once.
+        connection = connections[router.db_for_read(ModelDefinition)]
+        with CaptureQueriesContext(connection) as captured_queries:
+            model_def.get_state()
+        self.assertTrue(captured_queries)
+
     def test_natural_key(self):
         natural_key = self.model_def.natural_key()
         self.assertEqual(
@@ -238,6 +584,52 @@ class ModelDefinitionTest(BaseModelDefinitionTestCase):
         new_model_def.save()
 
 
+class ModelClassConstructionTest(BaseModelDefinitionTestCase):
+    # Definitions must be visible to the connections of other threads.
+    manual_transaction = True
+
+    def test_single_flight_construction(self):
+        """Make sure concurrent accesses to an obsolete model class result in
+        a single construction."""
+        field_def = CharFieldDefinition.objects.create(model_def=self.model_def, name='field', max_length=10)
+        model_class = self.model_def.model_class().model
+        # Simulate an alteration performed by another process.
+        CharFieldDefinition.objects.filter(pk=field_def.pk).update(max_length=20)
+        state_handler.set_checksum(self.model_def.pk, 'altered')
+        prepared = []
+        errors = []
+        start = Event()
+
+        def receiver(sender, **kwargs):
+            prepared.append(sender)
+
+        def access():
+            start.wait()
+            try:
+                MutableModelProxy(model_class)._meta.get_field('field')
+            except Exception as e:
+                errors.append(e)
+            finally:
+                for connection in connections.all():
+                    connection.close()
+        threads = [Thread(target=access) for _i in range(16)]
+        mutable_class_prepared.connect(receiver)
+        try:
+            for thread in threads:
+                thread.start()
+            start.set()
+            for thread in threads:
+                thread.join()
+        finally:
+            mutable_class_prepared.disconnect(receiver)
+        self.assertEqual(errors, [])
+        self.assertEqual(len(prepared), 1)
+        self.assertIs(self.model_def.model_class().model, prepared[0])
+        self.assertEqual(prepared[0]._meta.get_field('field').max_length, 20)
+        # Construction locks are not kept around once released.
+        self.assertNotIn(self.model_def.pk, _construction_locks)
+
+
 class ModelDefinitionManagerTest(BaseModelDefinitionTestCase):
     def test_fields_creation(self):
         char_field = CharFieldDefinition(name='name', max_length=10)
@@ -298,6 +690,41 @@ class ModelDefinitionManagerTest(BaseModelDefinitionTestCase):
         self.assertIsNotNone(field.pk)
         self.assertIsNotNone(base.pk)
 
+    def test_preload(self):
+        remove_from_app_cache(self.model_def.model_class())
+        state_handler.clear_checksum(self.model_def.pk)
+        timings = mutant.preload()
+        self.assertEqual(list(timings), ['load', 'order', 'render'])
+        model_class = apps.get_model('mutant', 'model')
+        self.assertIs(self.model_def.model_class().model, model_class)
+        self.assertEqual(state_handler.get_checksum(self.model_def.pk), model_class._checksum)
+
+    @skipUnless(hasattr(os, 'fork') and os.path.exists('/proc/self/smaps'), 'Requires fork and procfs.')
+    def test_preload_worker_memory(self):
+        """
+        Measure the memory of a worker forked from a preloaded process.
+        """
+        if hasattr(gc, 'unfreeze'):
+            self.addCleanup(gc.unfreeze)
+        mutant.preload(freeze=True)
+        model_class = self.model_def.model_class().model
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                os.close(read_fd)
+                reused = self.model_def.model_class().model is model_class
+                os.write(write_fd, json.dumps([reused] + list(get_memory_usage())).encode())
+            finally:
+                os._exit(0)
+        os.close(write_fd)
+        with os.fdopen(read_fd) as pipe:
+            reused, rss, private = json.loads(pipe.read())
+        os.waitpid(pid, 0)
+        self.assertTrue(reused)
+        # Most of the worker memory is shared with the preloaded process.
+        self.assertLess(private, rss / 2)
+
 
 class MutableModelProxyTest(BaseModelDefinitionTestCase):
     def test_pickling(self):
@@ -421,6 +848,74 @@ class MutableModelProxyTest(BaseModelDefinitionTestCase):
         # Cleanup the FK to avoid test pollution.
         model._meta.local_fields.remove(fk)
 
+    def test_max_staleness(self):
+        """Make sure proxies trust their last staleness check for the
+        configured window as long as the state generation doesn't move."""
+        proxy = self.model_def.model_class()
+        max_staleness = settings.STATE_MAX_STALENESS
+        path = state_handler.path
+        settings.STATE_MAX_STALENESS = 60
+        state_handler.path = 'tests.utils.CountingStateHandler'
+        try:
+            proxy.__get__()
+            CountingStateHandler.retrievals = 0
+            for _i in range(10):
+                proxy.objects.all()
+            self.assertEqual(CountingStateHandler.retrievals, 0)
+            # Altering the state should invalidate the last check.
+            CharFieldDefinition.objects.create(
+                model_def=self.model_def, name='name', max_length=10
+            )
+            CountingStateHandler.retrievals = 0
+            proxy.objects.all()
+            self.assertEqual(CountingStateHandler.retrievals, 1)
+            proxy.objects.create(name='Sergei')
+            # Marking the model class as obsolete should also be detected.
+            model = proxy.model
+            model.mark_as_obsolete()
+            proxy.objects.all()
+            self.assertFalse(proxy.model._is_obsolete)
+            # Checks are always performed when the window is disabled.
+            settings.STATE_MAX_STALENESS = 0
+            CountingStateHandler.retrievals = 0
+            for _i in range(10):
+                proxy.objects.all()
+            self.assertEqual(CountingStateHandler.retrievals, 10)
+        finally:
+            settings.STATE_MAX_STALENESS = max_staleness
+            state_handler.path = path
+
+    @benchmark
+    def test_max_staleness_benchmark(self):
+        """Report the duration of proxy attribute accesses within the
+        staleness window, with it disabled and of a bare attribute forwarding
+        proxy."""
+        class ForwardingProxy(object):
+            def __init__(self, model):
+                object.__setattr__(self, 'model', model)
+
+            def __getattribute__(self, name):
+                return getattr(object.__getattribute__(self, 'model'), name)
+        proxy = self.model_def.model_class()
+        forwarding_proxy = ForwardingProxy(proxy.model)
+        number = 10000
+
+        def measure(proxy):
+            # The fastest run is the least disturbed by other threads.
+            return min(repeat(lambda: proxy._meta, number=number, repeat=50)) / number
+        max_staleness = settings.STATE_MAX_STALENESS
+        try:
+            settings.STATE_MAX_STALENESS = 60
+            proxy.__get__()
+            window = measure(proxy)
+            settings.STATE_MAX_STALENESS = 0
+            checked = measure(proxy)
+        finally:
+            settings.STATE_MAX_STALENESS = max_staleness
+        report_benchmark(
+            'Proxy attribute access', window=window, checked=checked, forwarding=measure(forwarding_proxy)
+        )
+
 
 class OrderingDefinitionTest(BaseModelDefinitionTestCase):
     def setUp(self):
@@ -1,13 +1,33 @@
 from __future__ import unicode_literals
 
+import json
+import os
+import shutil
+import socket
+import tempfile
+import threading
 import time
-from threading import Thread
+from threading import Event, Thread
 from unittest import skipUnless
 
+from django.db import connection
+from django.db.models import Max
+from django.test import SimpleTestCase
+
+from mutant import state
+from mutant.contrib.text.models import CharFieldDefinition
+from mutant.middleware import StateSnapshotMiddleware
+from mutant.models import ChecksumRevision, ModelDefinition
 from mutant.state import handler as state_handler
-from mutant.state.handlers.pubsub import engines as pubsub_engines
+from mutant.state.handlers.database import DatabaseStateHandler
+from mutant.state.handlers.pubsub import (
+    engines as pubsub_engines, PubSubStateHandler,
+)
+from mutant.state.utils import HandlerProxy, StateMap
 
-from .utils import BaseModelDefinitionTestCase
+from .utils import (
+    benchmark, BaseModelDefinitionTestCase, CountingStateHandler, disabled_logger, report_benchmark,
+)
 
 try:
     import redis
@@ -33,10 +53,21 @@ class StateHandlerTestMixin(object):
         state_handler.clear_checksum(0)
         self.assertIsNone(state_handler.get_checksum(0))
 
+    def test_bulk_interaction(self):
+        self.assertEqual(state_handler.get_checksums([0, 1]), {0: None, 1: None})
+        checksums = {
+            0: '397fc6229a59429ee114441b780fe7a2',
+            1: 'c2c8d5e8b9ac8d94e7a3a9b1f6a26e0d',
+        }
+        state_handler.set_checksums(checksums)
+        self.assertEqual(state_handler.get_checksums([0, 1]), checksums)
+        state_handler.clear_checksum(0)
+        self.assertEqual(state_handler.get_checksums([0, 1]), {0: None, 1: checksums[1]})
+        state_handler.clear_checksum(1)
+
 
 class ChecksumGetter(Thread):
-    """Class used to fetch a checksum from a another thread since state
-    handler instances are thread local."""
+    """Class used to fetch a checksum from a another thread."""
 
     def __init__(self, definition_pk, *args, **kwargs):
         super(ChecksumGetter, self).__init__(*args, **kwargs)
@@ -64,11 +95,107 @@ class MemoryHandlerTest(StateHandlerTestMixin, BaseModelDefinitionTestCase):
         getter.join()
         self.assertIsNone(getter.checksum)
 
+    def test_concurrent_generation(self):
+        """Make sure concurrent changes don't lose generation bumps."""
+        handler = state_handler.get_handler()
+        generation = handler.generation
+
+        def change(offset):
+            for definition_pk in range(offset, offset + 100):
+                handler.set_checksum(definition_pk, 'checksum')
+                handler.clear_checksum(definition_pk)
+        threads = [Thread(target=change, args=(offset,)) for offset in range(0, 800, 100)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(handler.generation, generation + 1600)
+
 
 class CacheHandlerTest(StateHandlerTestMixin, BaseModelDefinitionTestCase):
     handler_path = 'mutant.state.handlers.cache.CacheStateHandler'
 
 
+class LocalDatabaseStateHandler(DatabaseStateHandler):
+    """Database state handler that doesn't poll from a background thread."""
+
+    checksums = {}
+    revision = None
+    checkpoints = None
+    poll_interval = None
+
+
+class DatabaseHandlerTest(StateHandlerTestMixin, BaseModelDefinitionTestCase):
+    handler_path = 'tests.test_state.LocalDatabaseStateHandler'
+
+    def get_process_handler(self):
+        """Simulate a distinct process by isolating the class level state."""
+        return type(str('ProcessDatabaseStateHandler'), (LocalDatabaseStateHandler,), {
+            'checksums': {},
+            'revision': None,
+            'checkpoints': None,
+        })()
+
+    def test_polling(self):
+        first, second = self.get_process_handler(), self.get_process_handler()
+        checksum = '397fc6229a59429ee114441b780fe7a2'
+        first.set_checksum(0, checksum)
+        first.set_checksum(1, checksum)
+        with self.assertNumQueries(0):
+            self.assertIsNone(second.get_checksum(0))
+        generation = second.generation
+        with self.assertNumQueries(1):
+            second.poll()
+        self.assertGreater(second.generation, generation)
+        self.assertEqual(second.get_checksum(0), checksum)
+        self.assertEqual(second.get_checksum(1), checksum)
+        first.clear_checksum(0)
+        second.poll()
+        self.assertIsNone(second.get_checksum(0))
+        self.assertEqual(second.get_checksum(1), checksum)
+        # Polling without changes shouldn't alter the generation.
+        generation = second.generation
+        second.poll()
+        self.assertEqual(second.generation, generation)
+
+    def test_out_of_order_commits(self):
+        """Changes committed after more recent ones should be applied."""
+        handler = self.get_process_handler()
+        revision = (ChecksumRevision.objects.aggregate(revision=Max('revision'))['revision'] or 0) + 10
+        ChecksumRevision.objects.create(revision=revision + 2, definition_pk=1, checksum='second')
+        handler.poll()
+        self.assertEqual(handler.get_checksum(1), 'second')
+        # The change to which a lower revision was assigned commits last.
+        ChecksumRevision.objects.create(revision=revision + 1, definition_pk=0, checksum='first')
+        generation = handler.generation
+        handler.poll()
+        self.assertGreater(handler.generation, generation)
+        self.assertEqual(handler.get_checksum(0), 'first')
+        self.assertEqual(handler.get_checksum(1), 'second')
+        # Changes retrieved again are not applied over more recent ones.
+        handler.set_checksum(0, 'third')
+        generation = handler.generation
+        handler.poll()
+        self.assertEqual(handler.generation, generation)
+        self.assertEqual(handler.get_checksum(0), 'third')
+        # Superseded revisions are removed.
+        self.assertEqual(
+            list(ChecksumRevision.objects.filter(definition_pk=0).values_list('checksum', flat=True)), ['third']
+        )
+        # Changes older than the overlap are not retrieved again.
+        handler.poll_overlap = 0
+        handler.poll()
+        handler.poll()
+        self.assertEqual(handler.get_watermark(time.time()), handler.revision)
+
+    def test_initial_synchronization(self):
+        checksum = '397fc6229a59429ee114441b780fe7a2'
+        self.get_process_handler().set_checksum(0, checksum)
+        with self.assertNumQueries(1):
+            handler = self.get_process_handler()
+        self.assertEqual(handler.get_checksum(0), checksum)
+
+
 @skipUnless(redis, 'This state handler requires redis to be installed.')
 class PubsubHandlerTest(MemoryHandlerTest):
     handler_path = 'mutant.state.handlers.pubsub.PubSubStateHandler'
@@ -85,3 +212,493 @@ class PubsubHandlerTest(MemoryHandlerTest):
         model_class.mark_as_obsolete()
         engine.join()
         self.assertEqual(len(messages), 0)
+
+
+class LockedStateMap(object):
+    """Map of checksums guarded by a single lock, the way the memory and
+    pubsub handlers used to track them, used as a reference."""
+
+    def __init__(self):
+        self.entries = {}
+        self.lock = threading.RLock()
+
+    def get(self, definition_pk):
+        entry = self.entries.get(definition_pk)
+        if entry is not None:
+            return entry[0]
+
+    def set(self, definition_pk, checksum, timestamp=None, newer=False):
+        if timestamp is None:
+            timestamp = time.time()
+        with self.lock:
+            entry = self.entries.get(definition_pk)
+            if newer and entry is not None and entry[1] > timestamp:
+                return False
+            self.entries[definition_pk] = (checksum, timestamp)
+        return True
+
+    def clear(self, definition_pk, timestamp=None, newer=False):
+        return self.set(definition_pk, None, timestamp, newer)
+
+
+def measure_throughput(state_map, iterations=5000, writers=4, readers=4):
+    """Return the operations per second sustained by `state_map` under
+    concurrent readers and writers."""
+    def write(offset):
+        for i in range(iterations):
+            definition_pk = offset + i % 50
+            state_map.set(definition_pk, str(i), newer=True)
+            if i % 3 == 0:
+                state_map.clear(definition_pk)
+
+    def read():
+        for i in range(iterations):
+            state_map.get(i % (50 * writers))
+    threads = [Thread(target=write, args=(offset * 50,)) for offset in range(writers)]
+    threads.extend(Thread(target=read) for _i in range(readers))
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return (writers + readers) * iterations / (time.time() - start)
+
+
+class StateMapTest(SimpleTestCase):
+    def test_newer(self):
+        state_map = StateMap()
+        self.assertTrue(state_map.set(0, 'second', 2.0, newer=True))
+        self.assertFalse(state_map.set(0, 'first', 1.0, newer=True))
+        self.assertEqual(state_map.get(0), 'second')
+        self.assertTrue(state_map.clear(0, 3.0, newer=True))
+        # Tombstones discard older changes.
+        self.assertFalse(state_map.set(0, 'second', 2.0, newer=True))
+        self.assertIsNone(state_map.get(0))
+        self.assertEqual(state_map.get_timestamp(0), 3.0)
+        self.assertTrue(state_map.set(0, 'first', 1.0))
+        self.assertEqual(state_map.get(0), 'first')
+
+    def test_tombstone_expiry(self):
+        state_map = StateMap(shards=1, tombstone_ttl=0)
+        for definition_pk in range(100):
+            state_map.set(definition_pk, 'checksum')
+            state_map.clear(definition_pk)
+        state_map.set(100, 'checksum')
+        self.assertEqual(len(state_map), 1)
+        self.assertEqual(len(state_map.shards[0].entries), 1)
+        self.assertEqual(len(state_map.shards[0].tombstones), 0)
+
+    def test_concurrency(self):
+        """Hammer the map with concurrent readers and writers."""
+        state_map = StateMap(tombstone_ttl=0)
+        iterations = 2000
+        errors = []
+
+        def write(offset):
+            try:
+                for i in range(iterations):
+                    definition_pk = offset + i % 50
+                    state_map.set(definition_pk, str(i), newer=True)
+                    if i % 3 == 0:
+                        state_map.clear(definition_pk)
+                state_map.set(offset, 'final')
+            except Exception as e:
+                errors.append(e)
+
+        def read():
+            try:
+                for i in range(iterations):
+                    checksum = state_map.get(i % 200)
+                    if checksum is not None:
+                        self.assertIsInstance(checksum, str)
+            except Exception as e:
+                errors.append(e)
+        threads = [Thread(target=write, args=(offset,)) for offset in (0, 50, 100, 150)]
+        threads.extend(Thread(target=read) for _i in range(4))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        for offset in (0, 50, 100, 150):
+            self.assertEqual(state_map.get(offset), 'final')
+
+    @benchmark
+    def test_concurrency_benchmark(self):
+        """Report the throughput of the map compared to the one of a map
+        guarded by a single lock."""
+        report_benchmark(
+            'State map operations per second',
+            sharded=max(measure_throughput(StateMap(tombstone_ttl=0)) for _i in range(3)),
+            locked=max(measure_throughput(LockedStateMap()) for _i in range(3)),
+        )
+
+
+class RecordingEngine(pubsub_engines.Engine):
+    """Engine recording the messages it sends."""
+
+    def __init__(self, callback, failures=0, **options):
+        super(RecordingEngine, self).__init__(callback, **options)
+        self.messages = []
+        self.failures = failures
+
+    def subscribe(self):
+        if self.failures:
+            self.failures -= 1
+            raise IOError('Connection refused')
+
+    def listen(self):
+        while not self.stopped.wait(0.01):
+            for message in self.messages:
+                yield message
+            self.messages = []
+
+    def send(self, message):
+        if self.failures:
+            self.failures -= 1
+            raise IOError('Connection lost')
+        self.messages.append(message)
+
+
+class RecordingPubSubStateHandler(PubSubStateHandler):
+    def get_engine(self):
+        # Widen the window during which concurrent threads could attempt to
+        # create their own handler.
+        time.sleep(0.01)
+        return RecordingEngine(self.receive)
+
+
+class HandlerProxyTest(SimpleTestCase):
+    def test_process_wide_handler(self):
+        proxy = HandlerProxy('tests.test_state.RecordingPubSubStateHandler')
+        handlers = []
+        start = Event()
+
+        def get_handler():
+            start.wait()
+            handlers.append(proxy.get_handler())
+        threads = [Thread(target=get_handler) for _i in range(32)]
+        for thread in threads:
+            thread.start()
+        start.set()
+        for thread in threads:
+            thread.join()
+        handler = proxy.get_handler()
+        self.addCleanup(handler.engine.join)
+        self.assertEqual(len(handlers), 32)
+        self.assertTrue(all(thread_handler is handler for thread_handler in handlers))
+        engines = [
+            thread for thread in threading.enumerate()
+            if isinstance(thread, RecordingEngine) and thread.callback == handler.receive
+        ]
+        self.assertEqual(engines, [handler.engine])
+
+
+class SlowForkHandler(object):
+    """Handler whose resources take a while to be re-established."""
+
+    def __init__(self):
+        self.forks = 0
+        self.ready = True
+
+    def after_fork(self):
+        self.ready = False
+        self.forks += 1
+        time.sleep(0.05)
+        self.ready = True
+
+
+class ForkedHandlerTest(BaseModelDefinitionTestCase):
+    def test_concurrent_after_fork(self):
+        proxy = HandlerProxy('tests.test_state.SlowForkHandler')
+        handler = proxy.get_handler()
+        proxy._pid = None
+        ready = []
+
+        def get_handler():
+            ready.append(proxy.get_handler().ready)
+        threads = [Thread(target=get_handler) for _i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(handler.forks, 1)
+        # Threads waited for the handler to be ready.
+        self.assertEqual(ready, [True] * 8)
+
+    @skipUnless(hasattr(os, 'register_at_fork'), 'Requires os.register_at_fork.')
+    def test_fork_lock(self):
+        proxy = HandlerProxy('tests.test_state.SlowForkHandler')
+        proxy.get_handler()
+        # Simulate a fork while another thread holds the lock.
+        fork_lock = proxy._fork_lock
+        fork_lock.acquire()
+        try:
+            pid = os.fork()
+            if pid == 0:
+                os._exit(0 if proxy._fork_lock is not fork_lock and proxy.get_handler().forks == 1 else 1)
+        finally:
+            fork_lock.release()
+        _pid, status = os.waitpid(pid, 0)
+        self.assertEqual(status, 0)
+
+    def test_after_fork(self):
+        proxy = HandlerProxy('tests.test_state.RecordingPubSubStateHandler')
+        handler = proxy.get_handler()
+        engine = handler.engine
+        engine.join()
+        definition_pk = self.model_def.pk
+        checksum = ModelDefinition.objects.checksums()[definition_pk]
+        self.assertIsNotNone(checksum)
+        # Simulate a change missed between the fork and the subscription.
+        handler.checksums.clear(definition_pk)
+        proxy._pid = None
+        with self.assertNumQueries(1):
+            self.assertIs(proxy.get_handler(), handler)
+        self.addCleanup(handler.engine.join)
+        self.assertIsNot(handler.engine, engine)
+        self.assertTrue(handler.engine.is_alive())
+        self.assertEqual(handler.get_checksum(definition_pk), checksum)
+        with self.assertNumQueries(0):
+            proxy.get_handler()
+
+
+class PubsubEngineTest(SimpleTestCase):
+    def test_immediate_publishing(self):
+        engine = RecordingEngine(None)
+        engine.publish(1, 'checksum', 1.0)
+        self.assertEqual([json.loads(message) for message in engine.messages], [
+            [1, 'checksum', 1.0],
+        ])
+
+    def test_batched_publishing(self):
+        engine = RecordingEngine(None, flush_interval=60)
+        engine.publish(1, 'first', 1.0)
+        engine.publish(2, 'second', 2.0)
+        engine.publish(1, 'third', 3.0)
+        self.assertEqual(engine.messages, [])
+        engine.flush()
+        self.assertEqual([json.loads(message) for message in engine.messages], [
+            [[2, 'second', 2.0], [1, 'third', 3.0]],
+        ])
+        engine.flush()
+        self.assertEqual(len(engine.messages), 1)
+
+    def test_message_size(self):
+        engine = RecordingEngine(None, flush_interval=60)
+        engine.max_message_size = 64
+        changes = [[pk, '397fc6229a59429ee114441b780fe7a2', 1.0] for pk in range(5)]
+        for change in changes:
+            engine.publish(*change)
+        engine.flush()
+        self.assertEqual(len(engine.messages), 5)
+        for message in engine.messages:
+            self.assertLessEqual(len(message), engine.max_message_size)
+        self.assertEqual([json.loads(message) for message in engine.messages], changes)
+        engine.max_message_size = 128
+        for change in changes:
+            engine.publish(*change)
+        engine.flush()
+        messages = [json.loads(message) for message in engine.messages[5:]]
+        self.assertEqual(messages, [changes[:2], changes[2:4], changes[4]])
+        for message in engine.messages[5:]:
+            self.assertLessEqual(len(message), engine.max_message_size)
+
+    def test_message_size_retry(self):
+        engine = RecordingEngine(None, flush_interval=60)
+        engine.max_message_size = 32
+        engine.publish(1, 'first', 1.0)
+        engine.publish(2, 'second', 2.0)
+        send = engine.send
+
+        def failing_send(message):
+            if engine.messages:
+                raise ValueError
+            send(message)
+        engine.send = failing_send
+        with disabled_logger():
+            engine.flush()
+        self.assertEqual([json.loads(message) for message in engine.messages], [[1, 'first', 1.0]])
+        # Only the changes that were not sent are retried.
+        self.assertEqual(list(engine.pending), [2])
+
+    def test_publishing_retry(self):
+        engine = RecordingEngine(None, failures=1)
+        with disabled_logger():
+            engine.publish(1, 'first', 1.0)
+        self.assertEqual(engine.messages, [])
+        engine.publish(2, 'second', 2.0)
+        self.assertEqual([json.loads(message) for message in engine.messages], [
+            [[1, 'first', 1.0], [2, 'second', 2.0]],
+        ])
+
+    def test_dispatch(self):
+        changes = []
+
+        def callback(*change):
+            changes.append(change)
+        engine = RecordingEngine(callback)
+        engine.dispatch('[1, "first", 1.0]')
+        engine.dispatch('[[2, "second", 2.0], [3, null, 3.0]]')
+        self.assertEqual(changes, [(1, 'first', 1.0), (2, 'second', 2.0), (3, None, 3.0)])
+
+    def test_resubscription(self):
+        received = Event()
+        engine = RecordingEngine(lambda *change: received.set(), failures=1, retry_interval=0.01)
+        with disabled_logger():
+            engine.start()
+            self.assertTrue(engine.subscribed.wait(5))
+        engine.publish(1, 'checksum', 1.0)
+        self.assertTrue(received.wait(5))
+        engine.join()
+
+
+@skipUnless(hasattr(socket, 'AF_UNIX'), 'UNIX sockets are not available.')
+class UnixSocketEngineTest(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def get_engine(self, callback):
+        engine = pubsub_engines.UnixSocket(callback, self.directory, timeout=0.01)
+        engine.start()
+        self.assertTrue(engine.subscribed.wait(5))
+        return engine
+
+    def get_process_handler(self):
+        """Simulate a distinct process by isolating the class level state."""
+        return type(str('ProcessPubSubStateHandler'), (PubSubStateHandler,), {
+            'checksums': StateMap(),
+            'get_engine': lambda handler: pubsub_engines.UnixSocket(
+                handler.receive, self.directory, timeout=0.01
+            ),
+        })()
+
+    def wait_for(self, condition):
+        for _i in range(500):
+            if condition():
+                return True
+            time.sleep(0.01)
+        return False
+
+    def test_fan_out(self):
+        changes = []
+        engines = [self.get_engine(lambda *change: changes.append(change)) for _i in range(2)]
+        engines[0].publish(1, 'checksum', 1.0)
+        self.assertTrue(self.wait_for(lambda: len(changes) == 2))
+        self.assertEqual(changes, [(1, 'checksum', 1.0)] * 2)
+        for engine in engines:
+            engine.join()
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_large_batch(self):
+        changes = []
+        engine = self.get_engine(lambda *change: changes.append(change))
+        engine.flush_interval = 60
+        expected = [(pk, '397fc6229a59429ee114441b780fe7a2', 1.0) for pk in range(5000)]
+        for change in expected:
+            engine.publish(*change)
+        engine.flush()
+        self.assertTrue(self.wait_for(lambda: len(changes) == len(expected)))
+        self.assertEqual(changes, expected)
+        engine.join()
+
+    def test_stale_socket_cleanup(self):
+        stale_path = os.path.join(self.directory, 'stale.sock')
+        stale_socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        stale_socket.bind(stale_path)
+        stale_socket.close()
+        changes = []
+        engine = self.get_engine(lambda *change: changes.append(change))
+        engine.publish(1, 'checksum', 1.0)
+        self.assertTrue(self.wait_for(lambda: changes))
+        self.assertFalse(os.path.exists(stale_path))
+        engine.join()
+
+    def test_pubsub_handler(self):
+        first, second = self.get_process_handler(), self.get_process_handler()
+        for handler in (first, second):
+            self.assertTrue(handler.engine.subscribed.wait(5))
+        checksum = '397fc6229a59429ee114441b780fe7a2'
+        first.set_checksum(0, checksum)
+        self.assertTrue(self.wait_for(lambda: second.get_checksum(0) == checksum))
+        second.clear_checksum(0)
+        self.assertTrue(self.wait_for(lambda: first.get_checksum(0) is None))
+        for handler in (first, second):
+            handler.engine.join()
+
+
+@skipUnless(connection.vendor == 'postgresql', 'This engine requires PostgreSQL.')
+class PostgreSQLEngineTest(SimpleTestCase):
+    def test_fan_out(self):
+        changes = []
+        engines = [
+            pubsub_engines.PostgreSQL(lambda *change: changes.append(change), timeout=0.01)
+            for _i in range(2)
+        ]
+        for engine in engines:
+            engine.start()
+            self.assertTrue(engine.subscribed.wait(5))
+        engines[0].publish(1, 'checksum', 1.0)
+        for _i in range(500):
+            if len(changes) == 2:
+                break
+            time.sleep(0.01)
+        self.assertEqual(changes, [(1, 'checksum', 1.0)] * 2)
+        for engine in engines:
+            engine.join()
+
+
+class StateSnapshotTest(BaseModelDefinitionTestCase):
+    def setUp(self):
+        super(StateSnapshotTest, self).setUp()
+        self._state_handler = state_handler.path
+        state_handler.path = 'tests.utils.CountingStateHandler'
+
+    def tearDown(self):
+        state_handler.path = self._state_handler
+        super(StateSnapshotTest, self).tearDown()
+
+    def test_snapshot(self):
+        proxy = self.model_def.model_class()
+        model_class = proxy.model
+        CountingStateHandler.retrievals = 0
+        with state.snapshot():
+            self.assertEqual(CountingStateHandler.retrievals, 1)
+            for _i in range(10):
+                proxy.objects.all()
+            # Changes made by others are not observed until the snapshot ends.
+            state_handler.get_handler().set_checksum(self.model_def.pk, 'changed')
+            self.assertIs(proxy.model, model_class)
+            with state.snapshot():
+                self.assertFalse(model_class.is_obsolete())
+            self.assertEqual(CountingStateHandler.retrievals, 1)
+        self.assertTrue(model_class.is_obsolete())
+        self.assertEqual(state_handler.get_snapshot(), None)
+
+    def test_snapshot_local_changes(self):
+        """Changes made during the unit of work should be observed."""
+        proxy = self.model_def.model_class()
+        with state.snapshot():
+            checksum = proxy.checksum()
+            CharFieldDefinition.objects.create(
+                model_def=self.model_def, name='name', max_length=10
+            )
+            self.assertNotEqual(proxy.checksum(), checksum)
+            self.assertEqual(state_handler.get_checksum(self.model_def.pk), proxy.checksum())
+
+    def test_middleware(self):
+        middleware = StateSnapshotMiddleware()
+        request, response = object(), object()
+        proxy = self.model_def.model_class()
+        CountingStateHandler.retrievals = 0
+        self.assertIsNone(middleware.process_request(request))
+        # Only the checksums of the accessed models are retrieved.
+        self.assertEqual(state_handler.get_snapshot(), {})
+        self.assertEqual(CountingStateHandler.retrievals, 0)
+        for _i in range(10):
+            proxy.objects.all()
+        self.assertEqual(CountingStateHandler.retrievals, 1)
+        self.assertEqual(state_handler.get_snapshot(), {self.model_def.pk: proxy.checksum()})
+        self.assertIs(middleware.process_response(request, response), response)
+        self.assertIsNone(state_handler.get_snapshot())
@@ -0,0 +1,155 @@
+from __future__ import unicode_literals
+
+from collections import defaultdict
+from contextlib import contextmanager
+from copy import deepcopy
+from threading import Thread
+from time import time
+
+from django.apps import AppConfig, apps
+from django.db import models
+from django.test import SimpleTestCase
+
+from mutant.utils import (
+    app_cache_restorer, apps_bulk_update, remove_from_app_cache,
+)
+
+from .utils import benchmark, report_benchmark
+
+
+def create_model(name, **attrs):
+    attrs.update(
+        __module__=str('tests.models'),
+        Meta=type(str('Meta'), (), {'app_label': 'tests', 'managed': False}),
+    )
+    return type(str(name), (models.Model,), attrs)
+
+
+class Empty(object):
+    pass
+
+
+def _app_cache_deepcopy(obj):
+    if isinstance(obj, defaultdict):
+        return deepcopy(obj)
+    elif isinstance(obj, dict):
+        return type(obj)((_app_cache_deepcopy(key), _app_cache_deepcopy(val)) for key, val in obj.items())
+    elif isinstance(obj, list):
+        return list(_app_cache_deepcopy(val) for val in obj)
+    elif isinstance(obj, AppConfig):
+        app_conf = Empty()
+        app_conf.__class__ = AppConfig
+        app_conf.__dict__ = _app_cache_deepcopy(obj.__dict__)
+        return app_conf
+    return obj
+
+
+@contextmanager
+def deepcopy_app_cache_restorer():
+    """
+    The previous implementation of `app_cache_restorer` used as a reference.
+    """
+    state = _app_cache_deepcopy(apps.__dict__)
+    try:
+        yield state
+    finally:
+        apps.__dict__ = state
+        for app_conf in apps.get_app_configs():
+            app_conf.models = apps.all_models[app_conf.label]
+        apps.clear_cache()
+
+
+class AppsBulkUpdateTest(SimpleTestCase):
+    def test_scoped_to_thread(self):
+        """Make sure the registry stays ready and only the registrations of
+        the current thread defer the expiry of options caches."""
+        unrelated = create_model('BulkUnrelated')
+        self.addCleanup(remove_from_app_cache, unrelated)
+
+        def register(name):
+            model = create_model(name)
+            self.addCleanup(remove_from_app_cache, model)
+            return model
+        with apps_bulk_update():
+            self.assertTrue(apps.ready)
+            unrelated._meta.related_objects
+            thread = Thread(target=register, args=('BulkOtherThread',))
+            thread.start()
+            thread.join()
+            self.assertNotIn('related_objects', unrelated._meta.__dict__)
+            unrelated._meta.related_objects
+            model = register('BulkCurrentThread')
+            self.assertIn('related_objects', unrelated._meta.__dict__)
+            self.assertIn(model, apps.get_models())
+        self.assertNotIn('related_objects', unrelated._meta.__dict__)
+        # The registry is left untouched once the block exits.
+        self.assertNotIn('clear_cache', apps.__dict__)
+
+
+class AppRegistryBenchmark(SimpleTestCase):
+    model_count = 1000
+
+    def setUp(self):
+        with apps_bulk_update():
+            self.target = create_model('BenchmarkTarget')
+            self.models = [
+                create_model('Benchmark%d' % i, target=models.ForeignKey(self.target, on_delete=models.CASCADE))
+                for i in range(self.model_count)
+            ]
+        self.addCleanup(self.remove_models)
+
+    def remove_models(self):
+        for model in self.models + [self.target]:
+            if model._meta.model_name in apps.all_models['tests']:
+                remove_from_app_cache(model)
+
+    def populate_caches(self):
+        for model in apps.get_models():
+            model._meta.fields
+            model._meta.related_objects
+
+    def test_remove_from_app_cache(self):
+        self.populate_caches()
+        removed, unrelated = self.models[0], self.models[1]
+        remove_from_app_cache(removed)
+        self.assertNotIn(removed, apps.get_models())
+        # Only the models related to the removed one are expired.
+        self.assertNotIn('fields', self.target._meta.__dict__)
+        self.assertIn('fields', unrelated._meta.__dict__)
+        self.assertNotIn(removed, [rel.related_model for rel in self.target._meta.related_objects])
+        self.assertIn(unrelated, [rel.related_model for rel in self.target._meta.related_objects])
+
+    @benchmark
+    def test_remove_from_app_cache_benchmark(self):
+        self.populate_caches()
+        start = time()
+        apps.clear_cache()
+        clear_cache_duration = time() - start
+        self.populate_caches()
+        start = time()
+        remove_from_app_cache(self.models[0])
+        report_benchmark(
+            'Removal from the app cache', clear_cache=clear_cache_duration, remove=time() - start
+        )
+
+    def restore(self, restorer):
+        self.populate_caches()
+        start = time()
+        with restorer():
+            remove_from_app_cache(self.target)
+        return time() - start
+
+    def test_app_cache_restorer(self):
+        self.restore(app_cache_restorer)
+        self.assertIs(apps.get_model('tests', 'benchmarktarget'), self.target)
+        self.assertIs(apps.get_app_config('tests').models, apps.all_models['tests'])
+        # Only the removed model is expired.
+        self.assertNotIn('fields', self.target._meta.__dict__)
+        self.assertIn('fields', self.models[0]._meta.__dict__)
+
+    @benchmark
+    def test_app_cache_restorer_benchmark(self):
+        report_benchmark(
+            'App cache restoration',
+            deepcopy=self.restore(deepcopy_app_cache_restorer), restorer=self.restore(app_cache_restorer),
+        )
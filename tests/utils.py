@@ -1,14 +1,30 @@
 from __future__ import unicode_literals
 
+import os
+import sys
 from contextlib import contextmanager
+from unittest import skipUnless
 
 from django.db import connections
 
+from mutant import logger
 from mutant.models.model import ModelDefinition
+from mutant.state.handlers.memory import MemoryStateHandler
 from mutant.test.testcases import ModelDefinitionDDLTestCase
 from mutant.utils import allow_migrate
 
 
+# Timings are too noisy to gate the suite on, benchmarks are only run when
+# the MUTANT_BENCHMARKS environment variable is set and report their results.
+benchmark = skipUnless(os.environ.get('MUTANT_BENCHMARKS'), 'Set MUTANT_BENCHMARKS to run benchmarks.')
+
+
+def report_benchmark(name, **timings):
+    sys.stderr.write("\n%s: %s\n" % (name, ', '.join(
+        "%s=%.3g" % (label, value) for label, value in sorted(timings.items())
+    )))
+
+
 def table_columns_iterator(db, table_name):
     connection = connections[db]
     cursor = connection.cursor()
@@ -16,6 +32,30 @@ def table_columns_iterator(db, table_name):
     return (row[0] for row in description)
 
 
+@contextmanager
+def disabled_logger():
+    disabled = logger.disabled
+    logger.disabled = True
+    try:
+        yield
+    finally:
+        logger.disabled = disabled
+
+
+class CountingStateHandler(MemoryStateHandler):
+    """Memory state handler that keeps track of checksum retrievals."""
+
+    retrievals = 0
+
+    def get_checksum(self, definition_pk):
+        CountingStateHandler.retrievals += 1
+        return super(CountingStateHandler, self).get_checksum(definition_pk)
+
+    def get_checksums(self, definition_pks):
+        CountingStateHandler.retrievals += 1
+        return super(CountingStateHandler, self).get_checksums(definition_pks)
+
+
 class BaseModelDefinitionTestCase(ModelDefinitionDDLTestCase):
     def setUp(self):
         self.model_def = ModelDefinition.objects.create(